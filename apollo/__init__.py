@@ -1,2 +1,9 @@
 _program = "apollo"
 __version__ = "0.2.1"
+
+def __getattr__(name):
+    # the counting api pulls in numpy and parasail, so it is only imported on first use
+    if name in ["count_methylation", "MethylationResult", "MethylationCounter"]:
+        from apollo import methylation
+        return getattr(methylation, name)
+    raise AttributeError(f"module 'apollo' has no attribute '{name}'")
@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 from apollo import __version__
-import setuptools
 import argparse
 import os.path
-import snakemake
 import sys
 from tempfile import gettempdir
 import tempfile
@@ -12,29 +10,39 @@ import json
 import csv
 import os
 from datetime import datetime
-from Bio import SeqIO
 import csv
 
-import pkg_resources
 from . import _program
 
 import apollofunks as qcfunk
-import custom_logger as custom_logger
-import log_handler_handle as lh
+import watchfunks
+import referencefunks
 
 thisdir = os.path.abspath(os.path.dirname(__file__))
 cwd = os.getcwd()
 
 def main(sysargs = sys.argv[1:]):
 
+    if sysargs and sysargs[0] == "build-reference":
+        return build_reference(sysargs[1:])
+    if sysargs and sysargs[0] == "predict-age":
+        return predict_age(sysargs[1:])
+    if sysargs and sysargs[0] == "serve":
+        return serve(sysargs[1:])
+
     parser = argparse.ArgumentParser(prog = _program, 
     description=qcfunk.preamble(__version__), 
     usage='''apollo -i <path/to/reads> [options]
-        apollo -c <config.yaml>''')
+        apollo -c <config.yaml>
+        apollo --batch <runs.csv> [options]
+        apollo build-reference [-s <species> ...]
+        apollo predict-age <cpg_wide.csv> [...] -s <species>
+        apollo serve [-s <species> ...] [--port <port>]''')
 
     io_group = parser.add_argument_group('input output options')
     io_group.add_argument('-c',"--configfile",help="Config file with apollo run settings",dest="configfile")
     io_group.add_argument('-i','--read-path',help="Path to the directory containing fastq files",dest="read_path")
+    io_group.add_argument('--batch',action="store",help="CSV or yaml file listing the run, read_path, species and barcodes_csv of several runs to count together",dest="batch")
     io_group.add_argument('-o','--output-prefix', action="store",help="Output prefix. Default: apollo_<species>_<date>")
     io_group.add_argument('--outdir', action="store",help="Output directory. Default: current working directory")
     io_group.add_argument('--tempdir',action="store",help="Specify where you want the temp stuff to go. Default: $TMPDIR")
@@ -47,14 +55,27 @@ def main(sysargs = sys.argv[1:]):
     demux_group = parser.add_argument_group('demultiplexing options')
     demux_group.add_argument('--demultiplex',action="store_true",help="Indicates that your reads have not been demultiplexed and will run guppy demultiplex on your provided read directory",dest="demultiplex")
     demux_group.add_argument('--path-to-guppy',action="store",help="Path to guppy_barcoder executable",dest="path_to_guppy")
+    demux_group.add_argument('--demultiplexer',action="store",help="Demultiplex with guppy_barcoder, or with apollo's built in demultiplexer (no guppy needed). Default: guppy. Options: guppy, apollo",dest="demultiplexer")
 
     run_group = parser.add_argument_group('run options')
     run_group.add_argument('-s',"--species", action="store",help="Indicate which species is being sequenced. Options: mus, apodemus, desmodus", dest="species")
     run_group.add_argument("-r","--report",action="store_true",help="Generate markdown report of estimated age")
+    run_group.add_argument("--clock-model",action="store",help="Csv of the site coefficients of the clock to estimate ages with. Default: the species' clock model",dest="clock_model")
+    run_group.add_argument("--no-primer-routing",action="store_true",help="Don't assign reads to amplicons by their primers before aligning",dest="no_primer_routing")
+    run_group.add_argument("--target-coverage",action="store",type=int,help="Stop counting a barcode once every CpG site has this many C+T reads. Default: count all reads",dest="target_coverage")
+    run_group.add_argument("--target-ci-width",action="store",type=float,help="Stop counting a barcode once the 95%% confidence interval of every site's methylation is narrower than this. Default: count all reads",dest="target_ci_width")
+    run_group.add_argument("--follow",action="store_true",help="Keep watching the read path while sequencing, updating the reports as new fastq files land")
+    run_group.add_argument("--follow-interval",action="store",type=int,help="Seconds between checks for new fastq files with --follow. Default: 10",dest="follow_interval")
+    run_group.add_argument("--follow-timeout",action="store",type=int,help="Stop following after this many seconds without new reads. Default: stop when MinKNOW writes its final summary",dest="follow_timeout")
     
     misc_group = parser.add_argument_group('misc options')
     misc_group.add_argument('-t', '--threads', action='store',type=int,help="Number of threads")
+    misc_group.add_argument('--shard-reads', action='store',type=int,help="Split barcodes with more than this many reads into shards that are counted as separate jobs. Default: no sharding",dest="shard_reads")
+    misc_group.add_argument('--shards', action='store',type=int,help="Number of shards to split large barcodes into. Default: number of threads",dest="shards")
+    misc_group.add_argument("--alignment-cache",action="store",help="Directory to keep the alignment of every read in, so reanalysing the same reads skips alignment",dest="alignment_cache")
+    misc_group.add_argument("--incremental",action="store_true",help="Only count barcodes and fastq files that are new or changed since the last run into --outdir")
     misc_group.add_argument("--no-temp",action="store_true",help="Output all intermediate files, for dev purposes.")
+    misc_group.add_argument("--compress-intermediates",action="store_true",help="Write the gathered reads gzip compressed to save space in the tempdir",dest="compress_intermediates")
     misc_group.add_argument("--verbose",action="store_true",help="Print lots of stuff to screen")
     misc_group.add_argument("-v","--version", action='version', version=f"apollo {__version__}")
 
@@ -86,6 +107,13 @@ def main(sysargs = sys.argv[1:]):
     # get data for a particular species, and get species
     qcfunk.get_package_data(thisdir, args.species, config)
     
+    # a rerun into the same outdir reuses the counts of unchanged barcodes and files
+    if args.incremental:
+        config["force"] = False
+    if not config["force"] and not args.outdir:
+        sys.stderr.write(qcfunk.cyan('Error: Please specify an `--outdir` to rerun into with `--incremental`.\n'))
+        sys.exit(-1)
+
     # default output dir
     qcfunk.get_outdir(args.outdir,args.output_prefix,cwd,config)
 
@@ -94,34 +122,45 @@ def main(sysargs = sys.argv[1:]):
 
     
 
-    config["cpg_header"] = qcfunk.make_cpg_header(config["cpg_sites"])
+    qcfunk.add_arg_to_config("report",args.report,config)
 
-    # add min and max read lengths to the config
-    qcfunk.get_read_length_filter(config)
+    # batch runs each have their own species, reads, barcodes csv and clock model, read from the batch file below
+    if not args.batch:
+        # add the cpg header and min and max read lengths to the config
+        qcfunk.get_reference_bundle(tempdir, config)
 
-    # looks for basecalled directory
-    qcfunk.look_for_basecalled_reads(args.read_path,cwd,config)
-    
-    # looks for the csv file saying which barcodes in sample
-    qcfunk.look_for_barcodes_csv(args.barcodes_csv,cwd,config)
+        # looks for basecalled directory
+        qcfunk.look_for_basecalled_reads(args.read_path,cwd,config)
+        
+        # looks for the csv file saying which barcodes in sample
+        qcfunk.look_for_barcodes_csv(args.barcodes_csv,cwd,config)
+
+        # the clock model ages are estimated with for the report
+        qcfunk.get_clock_model(args.clock_model,cwd,config)
 
     """
     Configure whether guppy barcoder needs to be run
     """
 
-    qcfunk.look_for_guppy_barcoder(args.demultiplex,args.path_to_guppy,cwd,config)
+    qcfunk.look_for_guppy_barcoder(args.demultiplex,args.path_to_guppy,args.demultiplexer,cwd,config)
 
+    qcfunk.check_barcode_kit(args.barcode_kit,config)
 
-    # don't run in quiet mode if verbose specified
-    if args.verbose:
-        quiet_mode = False
-        config["log_string"] = ""
-    else:
-        quiet_mode = True
-        lh_path = os.path.realpath(lh.__file__)
-        config["log_string"] = f"--quiet --log-handler-script {lh_path} "
+    # following reruns incrementally each time new reads land
+    qcfunk.add_arg_to_config("follow",args.follow,config)
+    qcfunk.add_arg_to_config("follow_interval",args.follow_interval,config)
+    qcfunk.add_arg_to_config("follow_timeout",args.follow_timeout,config)
+    if config["follow"]:
+        if config["demultiplex"]:
+            sys.stderr.write(qcfunk.cyan('Error: `--follow` needs reads that MinKNOW has already demultiplexed into barcode directories.\n'))
+            sys.exit(-1)
+        if args.batch:
+            sys.stderr.write(qcfunk.cyan('Error: `--follow` can only follow one run, not a `--batch`.\n'))
+            sys.exit(-1)
+        config["force"] = False
 
     qcfunk.add_arg_to_config("threads",args.threads,config)
+    qcfunk.add_arg_to_config("compress_intermediates",args.compress_intermediates,config)
     
     try:
         config["threads"]= int(config["threads"])
@@ -130,29 +169,166 @@ def main(sysargs = sys.argv[1:]):
         sys.exit(-1)
     threads = config["threads"]
 
+    if args.no_primer_routing:
+        config["primer_routing"] = False
+
+    qcfunk.get_alignment_cache(args.alignment_cache,cwd,config)
+
+    qcfunk.add_arg_to_config("target_coverage",args.target_coverage,config)
+    qcfunk.add_arg_to_config("target_ci_width",args.target_ci_width,config)
+
+    qcfunk.add_arg_to_config("shard_reads",args.shard_reads,config)
+    qcfunk.add_arg_to_config("shards",args.shards,config)
+    if not config["shards"]:
+        config["shards"] = threads
+
+    # every run of a batch is counted in one snakemake DAG, sharing the threads
+    forcerun = ["demultiplex"]
+    if args.batch:
+        runs = qcfunk.get_batch_runs(args.batch,thisdir,tempdir,cwd,config)
+        forcerun = [f"{run['module']}_demultiplex" for run in runs]
+
     print(f"Number of threads: {threads}\n")
 
     # find the master Snakefile
-    snakefile = qcfunk.get_snakefile(thisdir)
+    snakefile = qcfunk.get_snakefile(thisdir, "batch.smk" if args.batch else "Snakefile")
 
     if args.verbose:
         print("\n**** CONFIG ****")
         for k in sorted(config):
             print(qcfunk.green(k), config[k])
 
-        status = snakemake.snakemake(snakefile, printshellcmds=True, forceall=True, force_incomplete=True,
+    if config["follow"]:
+        print(qcfunk.green("Following:") + f" {config['read_path']}")
+        status = True
+        for snapshot in watchfunks.follow_reads(config["read_path"], config["follow_interval"], config["follow_timeout"]):
+            print(qcfunk.green("New reads:") + f" updating reports from {len(snapshot)} fastq files")
+            # a failed update, e.g. on a half written file, is retried when the next reads land
+            status = run_snakemake(snakefile, tempdir, config, threads, args.verbose, forcerun)
+            if not status:
+                sys.stderr.write(qcfunk.cyan('Warning: updating the reports failed, retrying with the next reads.\n'))
+        print(qcfunk.green("Finished following:") + f" {config['read_path']}")
+    else:
+        status = run_snakemake(snakefile, tempdir, config, threads, args.verbose, forcerun)
+
+    if status: # translate "success" into shell exit code of 0
+       return 0
+
+    return 1
+
+def run_snakemake(snakefile, tempdir, config, threads, verbose, forcerun):
+    # snakemake and the logger built on it take longer to import than the rest
+    # of apollo together, so commands that don't run the pipeline never load them
+    import snakemake
+    import custom_logger
+
+    # jobs with a run: block (the checkpoint and report gathering) run in threads rather
+    # than in a new snakemake process each, which would build the whole DAG again
+    if verbose:
+        status = snakemake.snakemake(snakefile, printshellcmds=True, forceall=config["force"], forcerun=forcerun, force_incomplete=True, force_use_threads=True,
                                         workdir=tempdir,config=config, cores=threads,lock=False
                                         )
     else:
         logger = custom_logger.Logger()
-        status = snakemake.snakemake(snakefile, printshellcmds=False, forceall=True,force_incomplete=True,workdir=tempdir,
+        status = snakemake.snakemake(snakefile, printshellcmds=False, forceall=config["force"],forcerun=forcerun,force_incomplete=True,force_use_threads=True,workdir=tempdir,
                                     config=config, cores=threads,lock=False,quiet=True,log_handler=logger.log_handler
                                     )
+    return status
 
-    if status: # translate "success" into shell exit code of 0
-       return 0
+def build_reference(sysargs):
+    parser = argparse.ArgumentParser(prog = f"{_program} build-reference",
+    description="Compile the references, CpG sites, substitution matrix and primers of each species into one bundle that every counting job loads instead of parsing them.")
+    parser.add_argument('-s',"--species", action="store", nargs="+", help="Species to compile. Default: all of them", dest="species")
+    args = parser.parse_args(sysargs)
 
-    return 1
+    import paramether
+
+    config = qcfunk.get_defaults()
+    for species in args.species or config["allowed_species"]:
+        qcfunk.get_package_data(thisdir, species, config)
+        if not os.path.exists(config["genes"]):
+            sys.stderr.write(qcfunk.cyan(f'No reference data installed for {species}, skipping.\n'))
+            continue
+        bundle_file = config["reference_bundle"]
+        bundle = paramether.make_reference_bundle(config["genes"], config["cpg_sites"], config["matrix_file"], config["primer_sequences"])
+        try:
+            referencefunks.write_reference_bundle(bundle_file, bundle)
+        except OSError:
+            sys.stderr.write(qcfunk.cyan(f'Error: cannot write {bundle_file}\nThe apollo install is not writable, each run will compile the bundle into its tempdir instead.\n'))
+            sys.exit(-1)
+        print(f"{species}: {len(bundle['references']) // 2} amplicons, {len(bundle['cpg_sites'])} CpG sites -> {bundle_file}")
+
+def predict_age(sysargs):
+    parser = argparse.ArgumentParser(prog = f"{_program} predict-age",
+    description="Estimate the age of every sample in one or more cpg_wide.csv reports, such as those of earlier runs, with a species' clock model.")
+    parser.add_argument("wide_files", nargs="+", help="cpg_wide.csv files to score")
+    parser.add_argument('-s',"--species", action="store", help="Species of the samples, whose clock model is used", dest="species")
+    parser.add_argument("--clock-model", action="store", help="Csv of the site coefficients of the clock. Default: the species' clock model", dest="clock_model")
+    parser.add_argument('-o',"--output", action="store", default="predicted_age.csv", help="Csv to write the ages to. Default: predicted_age.csv")
+    parser.add_argument("--markdown", action="store", help="Also write the ages as a markdown report")
+    args = parser.parse_args(sysargs)
+
+    import clockfunks
+    import numpy as np
+
+    config = qcfunk.get_defaults()
+    config["report"] = True
+    qcfunk.get_package_data(thisdir, args.species, config)
+    qcfunk.get_clock_model(args.clock_model, cwd, config)
+    model = clockfunks.load_clock_model(config["clock_model"])
+
+    # every sample of every file is scored together in one matrix product
+    samples = []
+    sources = []
+    runs = []
+    methylation = []
+    has_runs = False
+    for wide_file in args.wide_files:
+        if not os.path.exists(wide_file):
+            sys.stderr.write(qcfunk.cyan(f'Error: cannot find {wide_file}\n'))
+            sys.exit(-1)
+        try:
+            file_samples, file_methylation, file_runs = clockfunks.read_cpg_wide(wide_file, model["sites"])
+        except ValueError as error:
+            sys.stderr.write(qcfunk.cyan(f'Error: {error}\n'))
+            sys.exit(-1)
+        samples.extend(file_samples)
+        sources.extend([wide_file] * len(file_samples))
+        runs.extend(file_runs or [""] * len(file_samples))
+        has_runs = has_runs or file_runs is not None
+        methylation.append(file_methylation)
+    ages, imputed = clockfunks.predict_ages(model, np.vstack(methylation))
+
+    sources = sources if len(args.wide_files) > 1 else None
+    runs = runs if has_runs else None
+    clockfunks.write_age_table(args.output, samples, ages, imputed, sources, runs)
+    if args.markdown:
+        label_columns = [labels for labels in [sources, runs, samples] if labels is not None]
+        labels = [" ".join(filter(None, sample_labels)) for sample_labels in zip(*label_columns)]
+        clockfunks.write_markdown_report(args.markdown, "apollo age estimates", config["species"], config["clock_model"], model, labels, ages, imputed)
+    print(f"Estimated the age of {len(samples)} samples from {len(args.wide_files)} files -> {args.output}")
+
+def serve(sysargs):
+    parser = argparse.ArgumentParser(prog = f"{_program} serve",
+    description="Keep the references of each species and a pool of workers loaded, and count the read paths posted to http://127.0.0.1:<port>/jobs as they come in. The server only listens on the local machine.")
+    parser.add_argument('-s',"--species", action="store", nargs="+", help="Species to load. Default: all of them with reference data installed", dest="species")
+    parser.add_argument('-t',"--threads", action="store", type=int, default=1, help="Number of worker processes of each species. Default: 1")
+    parser.add_argument("--port", action="store", type=int, default=8790, help="Port to listen on. Default: 8790")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(sysargs)
+
+    config = qcfunk.get_defaults()
+    species = []
+    for name in args.species or config["allowed_species"]:
+        qcfunk.get_package_data(thisdir, name, config)
+        if os.path.exists(config["genes"]):
+            species.append(name)
+        elif args.species:
+            sys.stderr.write(qcfunk.cyan(f'Error: no reference data installed for {name}\n'))
+            sys.exit(-1)
+
+    from apollo import server
+    return server.serve(args.port, species, args.threads, args.verbose)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,151 @@
+# in-process methylation counting, for using apollo from other python code
+# without shelling out to paramether.py and reading its csvs back
+import os
+import sys
+import multiprocessing
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+
+# the helper modules live alongside the pipeline scripts and import each other
+# by name, as they do when run from the installed bin directory
+sys.path.insert(0, os.path.join(thisdir, "scripts"))
+import apollofunks
+import fastqfunks
+import paramether
+import referencefunks
+
+# species data is only compiled once per process, however many batches are counted
+bundles = {}
+
+def get_species_bundle(species):
+    if species not in bundles:
+        data_files = {
+            "references": f"data/{species}/genes.fasta",
+            "cpg_sites": f"data/{species}/cpg_sites.csv",
+            "substitution_matrix": "data/substitution_matrix.txt",
+            "primers": f"data/{species}/primer_sequences.csv"
+        }
+        source_files = {source: apollofunks.get_package_file(data_files[source]) for source in data_files}
+        if not os.path.exists(source_files["references"]):
+            raise ValueError(f"{species} is not configured in apollo")
+
+        # an up to date bundle from apollo build-reference is used if there is one,
+        # otherwise the data files are parsed here without writing into the install
+        bundle_file = apollofunks.get_package_file(f"data/{species}/reference_bundle.json")
+        bundle = referencefunks.load_reference_bundle(bundle_file, source_files)
+        if bundle is None:
+            bundle = paramether.make_reference_bundle(source_files["references"], source_files["cpg_sites"],
+                                                        source_files["substitution_matrix"], source_files["primers"])
+        bundles[species] = bundle
+    return bundles[species]
+
+class MethylationResult():
+    """Counts from one call of count_methylation.
+
+    sites: CpG site names, in the order of the apollo reports
+    cpg_counts: array of A, C, G, T, gap and other reads at each site, one row per site
+    reference_counts: number of reads assigned to each amplicon, unassigned reads as "None"
+    length_counts: reads that passed, or were too short or too long for, the read length filter
+    background_error_rate: fraction of C reads at non-CpG reference positions, which are
+        all T after bisulfite conversion, or None if no read aligned
+    """
+
+    def __init__(self, sites, cpg_counts, reference_counts, length_counts, background):
+        self.sites = sites
+        self.cpg_counts = cpg_counts
+        self.reference_counts = reference_counts
+        self.length_counts = length_counts
+        self.background = background
+        self.background_error_rate = paramether.get_background_error_rate(background)
+
+    def site_counts(self, site):
+        counts = self.cpg_counts[self.sites.index(site)]
+        site_counts = {base: int(counts[column]) for base, column in paramether.BASE_COLUMNS.items()}
+        site_counts["other"] = int(counts[paramether.OTHER_COLUMN])
+        return site_counts
+
+    @property
+    def methylation(self):
+        """Proportion of C among the C and T reads at each site, None where
+        there are too few of them, as reported in cpg_wide.csv."""
+        methylation = {}
+        for site, counts in zip(self.sites, self.cpg_counts):
+            c = int(counts[paramether.BASE_COLUMNS["C"]])
+            c_and_t = c + int(counts[paramether.BASE_COLUMNS["T"]])
+            methylation[site] = c / c_and_t if c_and_t > paramether.MIN_COVERAGE else None
+        return methylation
+
+    def write_reports(self, sample, report=None, counts=None):
+        """Write the cpg_wide and cpg_counts rows of this sample, the same as
+        paramether.py does."""
+        cpg_ids = {site: site_id for site_id, site in enumerate(self.sites)}
+        paramether.write_reports(sample, self.cpg_counts, cpg_ids, ",".join(["sample"] + self.sites), report, counts)
+
+def count_methylation(reads, species=apollofunks.DEFAULT_SPECIES, threads=1, chunk_size=1000, min_length=None, max_length=None,
+                        primer_routing=True, primer_search_length=150, kmer_size=12, candidates=2, cache_size=0):
+    """Align an iterable of read sequences to the amplicons of a species and
+    count the bases read at every CpG site, returning a MethylationResult.
+
+    Reads are length filtered as in the pipeline unless min_length and
+    max_length are given, 0 turns the filter off. With threads > 1 the reads
+    are aligned by a pool of worker processes. cache_size reads are kept in
+    memory by each process so exact duplicates aren't aligned again, which
+    only helps when the same reads are counted more than once."""
+    bundle = get_species_bundle(species)
+    if min_length is None:
+        min_length = bundle["min_length"]
+    if max_length is None:
+        max_length = bundle["max_length"]
+
+    # the count matrix rows follow the site ids, the same order as the report header
+    sites = [site[1] for site in sorted(bundle["cpg_sites"], key=lambda site: site[3])]
+
+    init_args = (bundle, kmer_size, candidates, primer_routing, primer_search_length, cache_size, None)
+    with paramether.worker_map(threads, init_args) as map_function:
+        result, = paramether.process_read_sets([reads], len(sites), map_function, chunk_size, min_length, max_length or None)
+
+    return MethylationResult(sites, result["cpg_counts"], result["counts"], result["length_counts"], result["background"])
+
+class MethylationCounter():
+    """Keeps the references of a species and a pool of worker processes
+    ready to align with, so batches of reads can be counted one after another
+    without starting the workers or compiling the references again.
+
+    Use as a context manager, or call close() when done, to stop the workers."""
+
+    def __init__(self, species=apollofunks.DEFAULT_SPECIES, threads=1, primer_routing=True, primer_search_length=150, kmer_size=12,
+                    candidates=2, cache_size=0):
+        self.species = species
+        self.threads = threads
+        self.bundle = get_species_bundle(species)
+        self.sites = [site[1] for site in sorted(self.bundle["cpg_sites"], key=lambda site: site[3])]
+
+        # the workers always run in their own processes, even with one thread,
+        # so counters of different species don't share the worker globals
+        init_args = (self.bundle, kmer_size, candidates, primer_routing, primer_search_length, cache_size, None)
+        self.pool = multiprocessing.Pool(threads, initializer=paramether.init_worker, initargs=init_args)
+
+    def map_function(self, function, iterable):
+        return fastqfunks.imap_bounded(self.pool, function, iterable, self.threads * 2)
+
+    def count(self, read_sets, chunk_size=1000, min_length=None, max_length=None):
+        """Count every iterable of read sequences in read_sets, returning a
+        MethylationResult for each. Reads are length filtered as in
+        count_methylation."""
+        if min_length is None:
+            min_length = self.bundle["min_length"]
+        if max_length is None:
+            max_length = self.bundle["max_length"]
+        results = paramether.process_read_sets(read_sets, len(self.sites), self.map_function, chunk_size, min_length, max_length or None)
+        return [MethylationResult(self.sites, result["cpg_counts"], result["counts"], result["length_counts"], result["background"])
+                    for result in results]
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -5,14 +5,16 @@ import os
 import argparse
 import csv 
 import sys
-from Bio import SeqIO
 from datetime import datetime 
 from datetime import date
 import tempfile
-import pkg_resources
-import yaml
+import json
+import importlib.resources
 import subprocess
 
+import fastqfunks
+import referencefunks
+
 END_FORMATTING = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
@@ -22,19 +24,35 @@ YELLOW = '\033[93m'
 CYAN = '\u001b[36m'
 DIM = '\033[2m'
 
+# also the species of count_methylation and apollo serve jobs that don't name one
+DEFAULT_SPECIES = "apodemus"
+
 def get_defaults():
     default_dict = {
         "no_temp":False,
         "demultiplex":False,
         "path_to_guppy":False,
         "barcode_kit":"native",
+        "demultiplexer":"guppy",
         "output_prefix":"apollo",
-        "species":"apodemus",
+        "species":DEFAULT_SPECIES,
         "barcodes":"native",
         "barcodes_csv":"",
         "configfile":False,
         "allowed_species":["apodemus","mus","desmodus","phalacrocorax"],
         "force":True,
+        "compress_intermediates":False,
+        "shard_reads":0,
+        "shards":0,
+        "primer_routing":True,
+        "alignment_cache":"",
+        "target_coverage":0,
+        "target_ci_width":0,
+        "follow":False,
+        "follow_interval":10,
+        "follow_timeout":0,
+        "report":False,
+        "clock_model":"",
         "threads":1
         }
     return default_dict
@@ -84,6 +102,7 @@ def look_for_config(configfile_arg,cwd, config):
     return configfile
 
 def parse_yaml_file(configfile,config):
+    import yaml
     with open(configfile,"r") as f:
         input_config = yaml.load(f, Loader=yaml.FullLoader)
         for key in input_config:
@@ -165,30 +184,59 @@ def get_temp_dir(tempdir_arg,no_temp_arg, cwd,config):
     config["tempdir"] = tempdir 
     return tempdir
     
+def get_alignment_cache(alignment_cache_arg,cwd,config):
+    add_arg_to_config("alignment_cache",alignment_cache_arg,config)
+    if config["alignment_cache"]:
+        expanded_path = os.path.expanduser(config["alignment_cache"])
+        config["alignment_cache"] = os.path.join(cwd,expanded_path)
+        print(green(f"Alignment cache:") + f" {config['alignment_cache']}")
+
 def get_read_length_filter(config):
     lengths = []
-    for record in SeqIO.parse(config["genes"],"fasta"):
-        lengths.append(len(record))
-    lengths = sorted(lengths)
-    config["min_length"] = lengths[0]
-    config["max_length"] = lengths[-1] + 200
+    for record_id, seq in referencefunks.read_fasta(config["genes"]):
+        lengths.append(len(seq))
+    config["min_length"], config["max_length"] = referencefunks.get_read_length_window(lengths)
+
+def get_reference_bundle(tempdir, config):
+    # a bundle compiled by apollo build-reference saves every job parsing the species data.
+    # Without one, or once the data files change, the jobs compile their own into the tempdir
+    source_files = {
+        "references": config["genes"],
+        "cpg_sites": config["cpg_sites"],
+        "substitution_matrix": config["matrix_file"],
+        "primers": config["primer_sequences"]
+    }
+    bundle = referencefunks.load_reference_bundle(config["reference_bundle"], source_files)
+    if bundle:
+        config["cpg_header"] = bundle["cpg_header"]
+        config["min_length"] = bundle["min_length"]
+        config["max_length"] = bundle["max_length"]
+    else:
+        config["reference_bundle"] = os.path.join(tempdir, f"{config['species']}_reference_bundle.json")
+        config["cpg_header"] = make_cpg_header(config["cpg_sites"])
+        get_read_length_filter(config)
+
+def get_package_file(path):
+    return str(importlib.resources.files("apollo").joinpath(path))
 
 def get_package_data(thisdir,species_arg, config):
-    matrix_file = pkg_resources.resource_filename('apollo', "data/substitution_matrix.txt")
+    matrix_file = get_package_file("data/substitution_matrix.txt")
     config["matrix_file"] = matrix_file
+    config["barcodes_file"] = get_package_file("data/barcodes.csv")
 
     add_arg_to_config("species",species_arg, config)
     
     species = config["species"]
 
     if species in config["allowed_species"]:
-        cpg_sites = pkg_resources.resource_filename('apollo', f"data/{species}/cpg_sites.csv")
-        genes = pkg_resources.resource_filename('apollo', f"data/{species}/genes.fasta")
-        primer_sequences = pkg_resources.resource_filename('apollo', f"data/{species}/primer_sequences.csv")
+        cpg_sites = get_package_file(f"data/{species}/cpg_sites.csv")
+        genes = get_package_file(f"data/{species}/genes.fasta")
+        primer_sequences = get_package_file(f"data/{species}/primer_sequences.csv")
 
         config["cpg_sites"] = cpg_sites
         config["genes"] = genes
         config["primer_sequences"] = primer_sequences
+        config["reference_bundle"] = get_package_file(f"data/{species}/reference_bundle.json")
     else:
         sys.stderr.write(cyan(f'Error: {species} specified not configured in apollo\nPlease select an alternative species. Allowed species are:\n'))
         for i in config["allowed_species"]:
@@ -197,12 +245,33 @@ def get_package_data(thisdir,species_arg, config):
 
 
 
-def look_for_guppy_barcoder(demultiplex_arg,path_to_guppy_arg,cwd,config):
+def get_clock_model(clock_model_arg,cwd,config):
+    # the species' clock model ships in its data directory, another can be given
+    # on the command line or in the config file
+    if clock_model_arg:
+        clock_model = os.path.join(cwd, os.path.expanduser(clock_model_arg))
+    elif config["clock_model"]:
+        clock_model = os.path.join(config.get("path_to_config", cwd), os.path.expanduser(config["clock_model"]))
+    else:
+        clock_model = get_package_file(f"data/{config['species']}/clock_model.csv")
+
+    if config["report"] and not os.path.exists(clock_model):
+        sys.stderr.write(cyan(f'Error: cannot find a clock model at {clock_model}\nNo clock model is installed for {config["species"]}, please give one with `--clock-model` to estimate ages.\n'))
+        sys.exit(-1)
+    config["clock_model"] = clock_model
+
+def look_for_guppy_barcoder(demultiplex_arg,path_to_guppy_arg,demultiplexer_arg,cwd,config):
 
     add_arg_to_config("demultiplex", demultiplex_arg, config)
     add_arg_to_config("path_to_guppy", path_to_guppy_arg, config)
-    
-    if config["demultiplex"]:
+    add_arg_to_config("demultiplexer", demultiplexer_arg, config)
+
+    if config["demultiplexer"] not in ["guppy","apollo"]:
+        sys.stderr.write(cyan(f'Error: Please enter a valid demultiplexer: one of\n\t-guppy\n\t-apollo\n'))
+        sys.exit(-1)
+
+    # the built in demultiplexer doesn't need guppy installed
+    if config["demultiplex"] and config["demultiplexer"] == "guppy":
 
         if config["path_to_guppy"]:
             expanded_path = os.path.expanduser(config["path_to_guppy"])
@@ -220,7 +289,7 @@ def look_for_guppy_barcoder(demultiplex_arg,path_to_guppy_arg,cwd,config):
         else:
             os_cmd = os.system(f"guppy_barcoder -v")
             if os_cmd != 0:
-                sys.stderr.write(cyan(f'Error: please provide the path to guppy_barcoder (`--path-to-guppy`), add guppy_barcoder to your path, or run demultiplexing in MinKNOW\n'))
+                sys.stderr.write(cyan(f'Error: please provide the path to guppy_barcoder (`--path-to-guppy`), add guppy_barcoder to your path, use `--demultiplexer apollo`, or run demultiplexing in MinKNOW\n'))
                 sys.exit(-1)
             else:
                 config["path_to_guppy"]
@@ -242,16 +311,8 @@ def look_for_basecalled_reads(read_path_arg,cwd,config):
             expanded_path = os.path.expanduser(config["read_path"])
             read_path = os.path.join(config["path_to_config"], expanded_path)
             config["read_path"] = read_path
-            fq_files = 0
-            for r,d,f in os.walk(read_path):
-                for fn in f:
-                    filename = fn.lower()
-                    if filename.endswith(".fastq") or filename.endswith(".fq"):
-                        fq_files +=1
-
-            if fq_files > 0:
-                print(f"Found {fq_files} fastq files in the input directory")
-            else:
+            # the files are listed once the pipeline runs, this only checks there are some
+            if not fastqfunks.has_fastq_files(read_path):
                 sys.stderr.write(cyan('Error: cannot find fastq files at {}\nPlease check your `--read-dir`'.format(read_path)))
                 sys.exit(-1)
     else:
@@ -298,24 +359,124 @@ def look_for_barcodes_csv(barcodes_csv_arg,cwd,config):
         config["barcodes"] = ""
         print(green(f"Note: No barcodes csv input"))
 
-def check_barcode_kit():
+def read_batch_file(batch_file):
+    if batch_file.endswith(".yaml") or batch_file.endswith(".yml"):
+        import yaml
+        with open(batch_file,"r") as f:
+            rows = yaml.load(f, Loader=yaml.FullLoader)
+        if isinstance(rows, dict):
+            rows = rows.get("runs")
+        if not isinstance(rows, list):
+            sys.stderr.write(cyan(f'Error: {batch_file} should be a list of runs, each with a `run`, `read_path` and `species`.\n'))
+            sys.exit(-1)
+    else:
+        with open(batch_file, newline="") as f:
+            rows = list(csv.DictReader(f))
+    return [{str(key).replace("-","_"): value for key, value in row.items()} for row in rows]
+
+def get_batch_runs(batch_arg,thisdir,tempdir,cwd,config):
+    """Make the config of every run in a batch file, a csv or yaml listing the
+    run, read_path, species and optionally barcodes_csv and clock_model of each
+    run. Runs are written to their own directory in the outdir, and paths in the
+    batch file are relative to it. The run configs are saved to batch_runs.json
+    in the outdir for the batch Snakefile."""
+    batch_file = os.path.join(cwd, os.path.expanduser(batch_arg))
+    if not os.path.exists(batch_file):
+        sys.stderr.write(cyan(f'Error: cannot find batch file at {batch_file}\n'))
+        sys.exit(-1)
+    batch_dir = os.path.dirname(batch_file)
+
+    runs = []
+    species_data = {}
+    for row in read_batch_file(batch_file):
+        for column in ["run","read_path","species"]:
+            if not row.get(column):
+                sys.stderr.write(cyan(f'Error: every run in {batch_file} needs a `{column}`.\n'))
+                sys.exit(-1)
+        run = str(row["run"])
+        if not all(c.isalnum() or c in "_.-" for c in run) or run == "reports":
+            sys.stderr.write(cyan(f'Error: run `{run}` can only contain letters, numbers, `_`, `.` and `-`, and can\'t be called `reports`.\n'))
+            sys.exit(-1)
+        if run in [run_config["run"] for run_config in runs]:
+            sys.stderr.write(cyan(f'Error: run `{run}` is listed more than once in {batch_file}\n'))
+            sys.exit(-1)
+
+        print(green(f"Run {run}:") + f" {row['species']}, {row['read_path']}")
+        run_config = dict(config)
+        run_config["run"] = run
+        run_config["module"] = f"run{len(runs)}"
+        get_package_data(thisdir, row["species"], run_config)
+
+        # every run of a species shares its reference bundle, cpg header and read length filter
+        species = run_config["species"]
+        if species not in species_data:
+            get_reference_bundle(tempdir, run_config)
+            species_data[species] = {key: run_config[key] for key in ["reference_bundle","cpg_header","min_length","max_length"]}
+        run_config.update(species_data[species])
+
+        run_config["outdir"] = os.path.join(config["outdir"], run)
+        if not os.path.exists(run_config["outdir"]):
+            os.mkdir(run_config["outdir"])
+
+        look_for_basecalled_reads(str(row["read_path"]), batch_dir, run_config)
+        run_config["barcodes_csv"] = ""
+        look_for_barcodes_csv(row.get("barcodes_csv"), batch_dir, run_config)
+        run_config["clock_model"] = ""
+        get_clock_model(row.get("clock_model"), batch_dir, run_config)
+        runs.append(run_config)
+
+    if not runs:
+        sys.stderr.write(cyan(f'Error: no runs found in {batch_file}\n'))
+        sys.exit(-1)
+
+    # passed as a file, snakemake turns every value of a nested config into a
+    # string in the processes it starts for jobs with a run: block
+    config["batch_runs"] = os.path.join(config["outdir"], "batch_runs.json")
+    with open(config["batch_runs"], "w") as fw:
+        json.dump(runs, fw, indent=4)
+    return runs
+
+def check_barcode_kit(barcode_kit_arg,config):
 
     add_arg_to_config("barcode_kit",barcode_kit_arg, config)
     barcode_kit = config["barcode_kit"]
-    if args.barcode_kit.lower() in ["native","pcr","rapid","all"]:
-        config["barcode_set"] = args.barcode_kit.lower()
+    if barcode_kit.lower() in ["native","pcr","rapid","all"]:
+        config["barcode_kit"] = barcode_kit.lower()
     else:
         sys.stderr.write(f"Error: Please enter a valid barcode kit: one of\n\t-native\n\t-pcr\n\t-rapid\n\t-all\n")
         sys.exit(-1)
 
 
-def get_snakefile(thisdir):
-    snakefile = os.path.join(thisdir, 'scripts','Snakefile')
+def get_snakefile(thisdir, name="Snakefile"):
+    snakefile = os.path.join(thisdir, 'scripts', name)
     if not os.path.exists(snakefile):
         sys.stderr.write(cyan(f'Error: cannot find Snakefile at {snakefile}\n Check installation\n'))
         sys.exit(-1)
     return snakefile
 
+def write_barcode_fingerprint(fastq_entries, fingerprint_file, config, shards=1):
+    """Record the reads, data files and settings a barcode is counted from,
+    taking the reads from the barcode's read manifest entries. The file is only
+    rewritten when this changes, so snakemake sees unchanged barcodes as up to
+    date when rerunning on the same output directory."""
+    lines = []
+    for entry in sorted(fastq_entries, key=lambda entry: entry["path"]):
+        lines.append(f"{os.path.abspath(entry['path'])}\t{entry['size']}\t{entry['mtime_ns']}")
+    for data_file in [config["genes"], config["cpg_sites"], config["matrix_file"], config["primer_sequences"]]:
+        lines.append(fastqfunks.get_file_fingerprint(data_file))
+    lines.append(f"min_length={config['min_length']}\tmax_length={config['max_length']}\tshards={shards}")
+    lines.append(f"target_coverage={config['target_coverage']}\ttarget_ci_width={config['target_ci_width']}\tprimer_routing={config['primer_routing']}")
+    fingerprint = "\n".join(lines) + "\n"
+
+    if os.path.exists(fingerprint_file):
+        with open(fingerprint_file, "r") as f:
+            if f.read() == fingerprint:
+                return False
+
+    with open(fingerprint_file, "w") as fw:
+        fw.write(fingerprint)
+    return True
+
 def make_cpg_header(cpg_csv):
     cpgs= ["sample"]
     with open(cpg_csv,"r") as f:
@@ -0,0 +1,77 @@
+# counts the runs of a batch manifest in one DAG, sharing the cores between them.
+# Each run is the main Snakefile loaded as a module with the run's own config
+# (species, reads and outdir), its rules prefixed with the run's module name.
+# workflow.module and workflow.userule are the internal api behind the `module`
+# and `use rule` keywords, which can't be used in a loop, so they may change
+# between snakemake releases: this is tested with snakemake 7 (environment.yml)
+import os
+import json
+
+with open(config["batch_runs"], "r") as f:
+    runs = json.load(f)
+
+for run in runs:
+    workflow.module(run["module"], snakefile=os.path.join(workflow.basedir, "Snakefile"), config=run)
+    workflow.userule(rules=["*"], from_module=run["module"], exclude_rules=[], name_modifier=f"{run['module']}_*")(lambda: None)
+
+batch_species = sorted(set(run["species"] for run in runs))
+
+def get_species_runs(species):
+    return [run for run in runs if run["species"] == species]
+
+rule all:
+    default_target: True
+    input:
+        [getattr(rules, f"{run['module']}_all").input for run in runs],
+        os.path.join(config["outdir"], "reports", "cpg_counts.csv"),
+        expand(os.path.join(config["outdir"], "reports", "{species}_cpg_wide.csv"), species=batch_species),
+        os.path.join(config["outdir"], "reports", "predicted_age.csv") if config["report"] else []
+
+rule gather_batch_counts:
+    input:
+        [os.path.join(run["outdir"], "reports", "cpg_counts.csv") for run in runs]
+    output:
+        os.path.join(config["outdir"], "reports", "cpg_counts.csv")
+    run:
+        with open(output[0], "w") as fw:
+            fw.write("run,species,sample,cpg_site,total,c,t,a,g,-\n")
+            for run_config, fn in zip(runs, input):
+                with open(str(fn), "r") as f:
+                    next(f)
+                    for l in f:
+                        fw.write(f"{run_config['run']},{run_config['species']},{l.rstrip()}\n")
+
+# the wide reports of runs of the same species share their columns, so they
+# are stacked into one table per species with the run as the first column
+rule gather_batch_wide:
+    input:
+        lambda wildcards: [os.path.join(run["outdir"], "reports", "cpg_wide.csv") for run in get_species_runs(wildcards.species)]
+    params:
+        runs = lambda wildcards: [run["run"] for run in get_species_runs(wildcards.species)]
+    output:
+        os.path.join(config["outdir"], "reports", "{species}_cpg_wide.csv")
+    wildcard_constraints:
+        species = "|".join(batch_species)
+    run:
+        with open(output[0], "w") as fw:
+            for i, (run_name, fn) in enumerate(zip(params.runs, input)):
+                with open(str(fn), "r") as f:
+                    header = next(f).rstrip()
+                    if i == 0:
+                        fw.write(f"run,{header}\n")
+                    for l in f:
+                        fw.write(f"{run_name},{l.rstrip()}\n")
+
+rule gather_batch_ages:
+    input:
+        [os.path.join(run["outdir"], "reports", "predicted_age.csv") for run in runs]
+    output:
+        os.path.join(config["outdir"], "reports", "predicted_age.csv")
+    run:
+        with open(output[0], "w") as fw:
+            fw.write("run,species,sample,predicted_age,sites_imputed\n")
+            for run_config, fn in zip(runs, input):
+                with open(str(fn), "r") as f:
+                    next(f)
+                    for l in f:
+                        fw.write(f"{run_config['run']},{run_config['species']},{l.rstrip()}\n")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import csv
+import numpy as np
+
+# samples with more than this fraction of the clock's sites imputed are
+# reported without an age rather than one mostly made of imputed values
+MAX_IMPUTED = 0.5
+
+INTERCEPT_NAMES = ["intercept", "(Intercept)"]
+
+def load_clock_model(model_file):
+    """Read a clock model csv with a site, coefficient and impute column: one
+    row for the intercept and one per CpG site, with the methylation used for
+    the site when a sample has no value for it (e.g. its mean in the training
+    samples). Lines starting with # are ignored."""
+    intercept = 0.0
+    sites = []
+    coefficients = []
+    impute = []
+    with open(model_file, newline="") as f:
+        reader = csv.DictReader(line for line in f if line.strip() and not line.startswith("#"))
+        for row in reader:
+            if row["site"] in INTERCEPT_NAMES:
+                intercept = float(row["coefficient"])
+                continue
+            if not row.get("impute"):
+                raise ValueError(f"{model_file}: site {row['site']} has no impute value")
+            sites.append(row["site"])
+            coefficients.append(float(row["coefficient"]))
+            impute.append(float(row["impute"]))
+    return {
+        "intercept": intercept,
+        "sites": sites,
+        "coefficients": np.array(coefficients),
+        "impute": np.array(impute)
+    }
+
+def read_cpg_wide(wide_file, sites):
+    """Read the samples of a cpg_wide.csv and their methylation at the given
+    sites, as a samples x sites array with NaN for NA and for sites the file
+    doesn't have. Also returns the run of each sample for the per-species
+    tables of a batch, which have a run column, or None."""
+    with open(wide_file, "r") as f:
+        header = f.readline().rstrip("\n").split(",")
+        lines = [line for line in f.read().splitlines() if line]
+    if "sample" not in header:
+        raise ValueError(f"{wide_file}: no sample column")
+
+    labels = [line.split(",") for line in lines]
+    samples = [row[header.index("sample")] for row in labels]
+    runs = [row[header.index("run")] for row in labels] if "run" in header else None
+
+    columns = {site: i for i, site in enumerate(header) if site not in ["sample", "run"]}
+    present = [j for j, site in enumerate(sites) if site in columns]
+    methylation = np.full((len(lines), len(sites)), np.nan)
+    if lines and present:
+        # every value of a site column is a proportion or NA
+        values = "\n".join(lines).replace(",NA", ",nan").splitlines()
+        methylation[:, present] = np.loadtxt(values, delimiter=",", usecols=[columns[sites[j]] for j in present], ndmin=2)
+    return samples, methylation, runs
+
+def predict_ages(model, methylation):
+    """Score every sample (row) of methylation, aligned to the model's sites,
+    in one matrix product. Returns the predicted ages, NaN where too many sites
+    had to be imputed, and the number of imputed sites of each sample."""
+    missing = np.isnan(methylation)
+    filled = np.where(missing, model["impute"], methylation)
+    ages = model["intercept"] + filled @ model["coefficients"]
+    imputed = missing.sum(axis=1)
+    ages[imputed > MAX_IMPUTED * len(model["sites"])] = np.nan
+    return ages, imputed
+
+def format_age(age):
+    return "NA" if np.isnan(age) else f"{age:.2f}"
+
+def write_age_table(age_csv, samples, ages, imputed, sources=None, runs=None):
+    # the file and run of each sample are only written when there is more than one
+    label_columns = [("source", sources), ("run", runs), ("sample", samples)]
+    label_columns = [(name, labels) for name, labels in label_columns if labels is not None]
+    with open(age_csv, "w") as fw:
+        fw.write(",".join(name for name, labels in label_columns) + ",predicted_age,sites_imputed\n")
+        for i, (age, n_imputed) in enumerate(zip(ages, imputed)):
+            fw.write(",".join(labels[i] for name, labels in label_columns) + f",{format_age(age)},{n_imputed}\n")
+
+def write_markdown_report(report_file, title, species, model_file, model, samples, ages, imputed):
+    lines = [
+        f"# {title}",
+        "",
+        f"Species: {species}  ",
+        f"Clock model: `{model_file}` ({len(model['sites'])} CpG sites)",
+        "",
+        "| sample | predicted age | sites imputed |",
+        "| --- | ---: | ---: |"
+    ]
+    for sample, age, n_imputed in zip(samples, ages, imputed):
+        lines.append(f"| {sample} | {format_age(age)} | {n_imputed} of {len(model['sites'])} |")
+    lines.append("")
+    lines.append(f"Sites without enough C and T reads are imputed from the model. Samples with more than {MAX_IMPUTED:.0%} of the sites imputed are not given an age (NA).")
+    with open(report_file, "w") as fw:
+        fw.write("\n".join(lines) + "\n")
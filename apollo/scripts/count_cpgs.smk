@@ -1,52 +1,112 @@
-import os
-from Bio import SeqIO
-import apollofunks as qcfunk
+# included by the main Snakefile, which discovers the barcodes with the demultiplex
+# checkpoint and sets config["barcode_path"], gather_reads and gathered_extension.
+# Jobs depend on the per-barcode fingerprint rather than on the checkpoint output,
+# so with --incremental only barcodes whose reads changed are counted again.
+# Settings reach the shell commands through params rather than {config[...]},
+# which batch runs would format with the batch config instead of the run's own.
+import math
+import shlex
 
-
-rule all:
-    input:
-        os.path.join(config["outdir"], "reports","cpg_counts.csv"),
-        os.path.join(config["outdir"], "reports","cpg_wide.csv"),
-        expand(os.path.join(config["outdir"],"gathered_reads","{barcode}.fastq"), barcode=config["barcodes"])
+import clockfunks
+import fastqfunks
 
 rule gather_demuxed_reads:
     input:
+        fingerprint = os.path.join(config["outdir"],"fingerprints","{barcode}.txt")
     params:
-        barcode_path = os.path.join(config["read_path"],"{barcode}"),
         barcode = "{barcode}"
     output:
-        reads = os.path.join(config["outdir"],"gathered_reads","{barcode}.fastq")
+        reads = os.path.join(config["outdir"],"gathered_reads","{barcode}" + gathered_extension)
     run:
-        with open(output.reads, "w") as fw:
-            reads = []
-            for r,d,f in os.walk(params.barcode_path):
-                for fn in f:
-                    if fn.endswith(".fastq") or fn.endswith(".fq"):
-                        for record in SeqIO.parse(os.path.join(r, fn),"fastq"):
-                            if len(record) > config["min_length"] and len(record) < config["max_length"]:
-                                reads.append(record)
-            SeqIO.write(reads,fw,"fastq")
-            print(qcfunk.green(f"Barcode {params.barcode}: ") + f"{len(reads)}")
+        fastq_files = fastqfunks.get_manifest_files(get_read_manifest(), params.barcode)
+        with fastqfunks.open_fastq(output.reads, "w") as fw:
+            length_counts = fastqfunks.write_length_filtered_reads(fastq_files, fw, config["min_length"], config["max_length"])
+        print(qcfunk.green(f"Barcode {params.barcode}: ") + f"{length_counts['passed']}" +
+                f" (rejected {length_counts['too_short']} too short, {length_counts['too_long']} too long)")
+
+def get_shard_counts(wildcards):
+    shards = get_barcode_shards()[wildcards.barcode]
+    return expand(os.path.join(config["outdir"],"counts","shards","{barcode}.{shard}.cpg_counts.csv"), 
+                    barcode=wildcards.barcode, shard=range(shards))
+
+def get_barcode_threads(wildcards):
+    # a barcode gets a share of the cores by the size of its reads, so small
+    # barcodes don't hold every core while the large ones wait
+    if config["shard_reads"]:
+        return 1
+    barcodes = get_read_manifest()
+    barcode_size = sum(entry["size"] for entry in barcodes[wildcards.barcode])
+    total_size = sum(entry["size"] for barcode in barcodes for entry in barcodes[barcode])
+    if not total_size:
+        return 1
+    return max(1, min(workflow.cores, math.ceil(workflow.cores * barcode_size / total_size)))
 
 rule paramether:
     input:
-        reads = rules.gather_demuxed_reads.output.reads,
+        reads = rules.gather_demuxed_reads.output.reads if gather_reads else [],
         genes = config["genes"],
         cpg_sites = config["cpg_sites"],
         matrix_file = config["matrix_file"],
+        primers = config["primer_sequences"],
+        fingerprint = os.path.join(config["outdir"],"fingerprints","{barcode}.txt")
     params:
-        sample = "{barcode}"
+        sample = "{barcode}",
+        bundle = config["reference_bundle"],
+        reads = "--reads " + shlex.quote(rules.gather_demuxed_reads.output.reads) if gather_reads else "--read-manifest " + shlex.quote(read_manifest_dir),
+        shards = lambda wildcards: get_barcode_shards()[wildcards.barcode],
+        primers = lambda wildcards, input: "--primers " + shlex.quote(input.primers) if config["primer_routing"] else "",
+        cache = "--cache-dir " + shlex.quote(config["alignment_cache"]) if config["alignment_cache"] else "",
+        partials = lambda wildcards: "" if config["force"] else "--partials-dir " + shlex.quote(os.path.join(config["outdir"],"partial_counts",wildcards.barcode)),
+        min_length = config["min_length"],
+        max_length = config["max_length"],
+        cpg_header = config["cpg_header"],
+        target_coverage = config["target_coverage"],
+        target_ci_width = config["target_ci_width"]
+    wildcard_constraints:
+        shard = "\d+"
+    threads:
+        get_barcode_threads
     output:
-        counts_long = os.path.join(config["outdir"],"counts","{barcode}.cpg_counts.csv"),
-        counts_wide = os.path.join(config["outdir"],"counts","{barcode}.cpg_wide.csv")
+        counts_long = os.path.join(config["outdir"],"counts","shards","{barcode}.{shard}.cpg_counts.csv")
     shell:
         """
         paramether.py \
-            --reads {input.reads:q} \
+            {params.reads} \
+            --min-length {params.min_length} \
+            --max-length {params.max_length} \
             --reference {input.genes:q} \
             --cpg_csv {input.cpg_sites:q} \
-            --cpg-header {config[cpg_header]} \
+            --cpg-header {params.cpg_header} \
             --substitution_matrix {input.matrix_file:q} \
+            --bundle {params.bundle:q} \
+            {params.primers} \
+            --sample {params.sample} \
+            --shard {wildcards.shard} \
+            --shards {params.shards} \
+            --threads {threads} \
+            --target-coverage {params.target_coverage} \
+            --target-ci-width {params.target_ci_width} \
+            {params.partials} \
+            {params.cache} \
+            --counts {output.counts_long:q}
+        """
+
+rule merge_shards:
+    input:
+        shard_counts = get_shard_counts,
+        cpg_sites = config["cpg_sites"]
+    params:
+        sample = "{barcode}",
+        cpg_header = config["cpg_header"]
+    output:
+        counts_long = os.path.join(config["outdir"],"counts","{barcode}.cpg_counts.csv"),
+        counts_wide = os.path.join(config["outdir"],"counts","{barcode}.cpg_wide.csv")
+    shell:
+        """
+        paramether.py \
+            --merge-counts {input.shard_counts:q} \
+            --cpg_csv {input.cpg_sites:q} \
+            --cpg-header {params.cpg_header} \
             --sample {params.sample} \
             --report {output.counts_wide:q} \
             --counts {output.counts_long:q}
@@ -54,7 +114,7 @@ rule paramether:
 
 rule gather_reports:
     input:
-        expand(os.path.join(config["outdir"],"counts","{barcode}.cpg_wide.csv"), barcode = config["barcodes"])
+        get_barcode_outputs(os.path.join(config["outdir"],"counts","{barcode}.cpg_wide.csv"))
     output:
         os.path.join(config["outdir"],"reports","cpg_wide.csv")
     run:
@@ -70,7 +130,7 @@ rule gather_reports:
 
 rule gather_counts:
     input:
-        expand(os.path.join(config["outdir"],"counts","{barcode}.cpg_counts.csv"), barcode = config["barcodes"])
+        get_barcode_outputs(os.path.join(config["outdir"],"counts","{barcode}.cpg_counts.csv"))
     output:
         os.path.join(config["outdir"],"reports","cpg_counts.csv")
     run:
@@ -80,3 +140,20 @@ rule gather_counts:
                 with open(str(fn),"r") as f:
                     for l in f:
                         fw.write(l.rstrip() + '\n')
+
+rule predict_age:
+    input:
+        wide = rules.gather_reports.output[0],
+        clock_model = config["clock_model"]
+    params:
+        species = config["species"],
+        title = f"apollo report: {config['output_prefix']}"
+    output:
+        ages = os.path.join(config["outdir"],"reports","predicted_age.csv"),
+        report = os.path.join(config["outdir"],f"{config['output_prefix']}.md")
+    run:
+        model = clockfunks.load_clock_model(input.clock_model)
+        samples, methylation, runs = clockfunks.read_cpg_wide(input.wide, model["sites"])
+        ages, imputed = clockfunks.predict_ages(model, methylation)
+        clockfunks.write_age_table(output.ages, samples, ages, imputed)
+        clockfunks.write_markdown_report(output.report, params.title, params.species, input.clock_model, model, samples, ages, imputed)
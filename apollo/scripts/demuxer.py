@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import csv
+from collections import Counter
+import collections
+import multiprocessing
+import parasail
+
+import fastqfunks
+import referencefunks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Demultiplex ONT barcoded reads into barcode directories')
+
+    parser.add_argument("--reads", action="store", nargs="+", type=str, dest="reads",
+                        help="Fastq files, or directories of fastq files")
+    parser.add_argument("--barcodes-file", action="store", type=str, dest="barcodes_file")
+    parser.add_argument("--kit", action="store", type=str, dest="kit", default="native",
+                        help="Barcode kit the reads were prepared with: native, rapid, pcr or all")
+    parser.add_argument("--outdir", action="store", type=str, dest="outdir")
+    parser.add_argument("--threads", action="store", type=int, dest="threads", default=1)
+    parser.add_argument("--chunk-size", action="store", type=int, dest="chunk_size", default=1000)
+    parser.add_argument("--search-length", action="store", type=int, dest="search_length", default=150,
+                        help="Number of bases at each end of a read to search for the barcode")
+    parser.add_argument("--max-errors", action="store", type=int, dest="max_errors", default=4,
+                        help="Maximum edit distance between a barcode and the read")
+    parser.add_argument("--min-margin", action="store", type=int, dest="min_margin", default=3,
+                        help="Minimum difference in edit distance between the best and second best barcode")
+    parser.add_argument("--kmer-size", action="store", type=int, dest="kmer_size", default=5,
+                        help="Rank barcodes by shared k-mers before aligning, 0 aligns every barcode")
+    parser.add_argument("--candidates", action="store", type=int, dest="candidates", default=3)
+
+    return parser.parse_args()
+
+# unit costs, so the alignment score is minus the edit distance
+EDIT_MATRIX = parasail.matrix_create("ACGTN", 0, -1)
+GAP_OPEN = 1
+GAP_EXTENSION = 1
+
+def load_barcodes(barcodes_file, kit):
+    # the rapid and pcr barcodes are the reverse complements of the native ones of
+    # the same name, and each read end is only searched in one orientation, so "all"
+    # keeps every distinct sequence of a barcode: {barcode: [sequence, ...]}
+    barcodes = collections.defaultdict(list)
+    with open(barcodes_file, "r") as f:
+        for row in csv.DictReader(f):
+            if kit in [row["kit"], "all"] and row["sequence"] not in barcodes[row["barcode"]]:
+                barcodes[row["barcode"]].append(row["sequence"])
+    return dict(barcodes)
+
+def make_barcode_kmer_index(barcodes, kmer_size=5):
+    kmer_index = collections.defaultdict(list)
+    for barcode in barcodes:
+        kmers = set(seq[i:i+kmer_size] for seq in barcodes[barcode] for i in range(len(seq) - kmer_size + 1))
+        for kmer in kmers:
+            kmer_index[kmer].append(barcode)
+    return kmer_index
+
+def get_candidate_barcodes(read_ends, kmer_index, kmer_size=5, max_candidates=3):
+    hits = Counter()
+    for read_end in read_ends:
+        for i in range(len(read_end) - kmer_size + 1):
+            kmer = read_end[i:i+kmer_size]
+            if kmer in kmer_index:
+                hits.update(kmer_index[kmer])
+    return [barcode for barcode,count in hits.most_common(max_candidates)]
+
+def get_read_ends(seq, search_length=150):
+    # the barcode ligated to the far end of the read reads as its reverse complement
+    return [seq[:search_length], referencefunks.reverse_complement(seq[-search_length:])]
+
+def classify_read(seq, barcode_profiles, max_errors=4, min_margin=3, kmer_index=None, kmer_size=5, max_candidates=3, search_length=150):
+    read_ends = get_read_ends(seq.upper(), search_length)
+
+    candidates = barcode_profiles
+    if kmer_index is not None:
+        candidates = get_candidate_barcodes(read_ends, kmer_index, kmer_size, max_candidates)
+
+    # semi-global with free gaps in the read, so the barcode itself must align end to end.
+    # A barcode scores its best sequence, so with "all" its kits never compete for the margin
+    errors = []
+    for barcode in candidates:
+        barcode_errors = min(-parasail.sg_dx_scan_profile_16(profile, read_end, GAP_OPEN, GAP_EXTENSION).score
+                                for profile in barcode_profiles[barcode] for read_end in read_ends)
+        errors.append((barcode_errors, barcode))
+    errors.sort()
+
+    if not errors or errors[0][0] > max_errors:
+        return "unclassified"
+    if len(errors) > 1 and errors[1][0] - errors[0][0] < min_margin:
+        return "unclassified"
+    return errors[0][1]
+
+# each worker process builds its own barcode profiles and index once
+worker_data = {}
+
+def init_worker(barcodes, settings):
+    worker_data["barcode_profiles"] = {barcode: [parasail.profile_create_16(seq, EDIT_MATRIX) for seq in barcodes[barcode]]
+                                        for barcode in barcodes}
+    worker_data["kmer_index"] = None
+    if settings["kmer_size"]:
+        worker_data["kmer_index"] = make_barcode_kmer_index(barcodes, settings["kmer_size"])
+    worker_data["settings"] = settings
+
+def classify_chunk(records):
+    settings = worker_data["settings"]
+    classified = []
+    for name, seq, qual in records:
+        barcode = classify_read(seq, worker_data["barcode_profiles"], settings["max_errors"], settings["min_margin"],
+                                worker_data["kmer_index"], settings["kmer_size"], settings["candidates"], settings["search_length"])
+        classified.append((barcode, f"@{name}\n{seq}\n+\n{qual}\n"))
+    return classified
+
+def demultiplex_reads(fastq_files, outdir, map_function=map, chunk_size=1000, threads=1):
+    """Write every read of fastq_files into outdir/<barcode>/reads.fastq,
+    returning the number of reads written for each barcode."""
+    barcode_counts = Counter()
+    handles = {}
+    records = (record for fastq_file in fastq_files for record in fastqfunks.read_fastq(fastq_file, threads))
+    try:
+        for classified in map_function(classify_chunk, fastqfunks.chunk_reads(records, chunk_size)):
+            for barcode, record in classified:
+                if barcode not in handles:
+                    os.makedirs(os.path.join(outdir, barcode), exist_ok=True)
+                    handles[barcode] = open(os.path.join(outdir, barcode, "reads.fastq"), "w")
+                handles[barcode].write(record)
+                barcode_counts[barcode] += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return barcode_counts
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    kit = args.kit.lower()
+    barcodes = load_barcodes(args.barcodes_file, kit)
+    if not barcodes:
+        sys.stderr.write(f"Error: no barcodes found for kit {kit} in {args.barcodes_file}\n")
+        sys.exit(-1)
+
+    fastq_files = fastqfunks.get_fastq_files(args.reads)
+    settings = {
+        "max_errors": args.max_errors,
+        "min_margin": args.min_margin,
+        "kmer_size": args.kmer_size,
+        "candidates": args.candidates,
+        "search_length": args.search_length
+    }
+
+    if args.threads > 1:
+        with multiprocessing.Pool(args.threads, initializer=init_worker, initargs=(barcodes, settings)) as pool:
+            pool_map = lambda function, iterable: fastqfunks.imap_bounded(pool, function, iterable, args.threads * 2)
+            barcode_counts = demultiplex_reads(fastq_files, args.outdir, pool_map, args.chunk_size, args.threads)
+    else:
+        init_worker(barcodes, settings)
+        barcode_counts = demultiplex_reads(fastq_files, args.outdir, map, args.chunk_size, args.threads)
+
+    for barcode in sorted(barcode_counts):
+        print(f"{barcode}: {barcode_counts[barcode]}")
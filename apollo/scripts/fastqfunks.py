@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import gzip
+import json
+import itertools
+import collections
+import shutil
+import subprocess
+from contextlib import contextmanager
+from collections import Counter
+
+FASTQ_EXTENSIONS = (".fastq", ".fq")
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bgz": "gzip",
+    ".zst": "zstd"
+}
+
+# external (de)compressors are preferred when installed, they run alongside
+# the python parser and can use more than one thread
+COMPRESSION_COMMANDS = {
+    "gzip": [["pigz", "-p", "{threads}"], ["igzip", "-T", "{threads}"], ["gzip"]],
+    "zstd": [["zstd", "-q", "-T{threads}"]]
+}
+
+def get_compression(filename):
+    name = filename.lower()
+    for extension in COMPRESSION_EXTENSIONS:
+        if name.endswith(extension):
+            return COMPRESSION_EXTENSIONS[extension]
+    return None
+
+def get_compression_command(compression, threads):
+    for command in COMPRESSION_COMMANDS[compression]:
+        path = shutil.which(command[0])
+        if path:
+            return [path] + [arg.format(threads=threads) for arg in command[1:]]
+    return None
+
+@contextmanager
+def open_fastq(fastq_file, mode="r", threads=1):
+    """Open a plain, gzip/bgzip or zstd compressed fastq file as a text stream.
+    The compression is picked from the file extension."""
+    compression = get_compression(fastq_file)
+    if compression is None:
+        with open(fastq_file, mode) as f:
+            yield f
+        return
+
+    command = get_compression_command(compression, threads)
+    if command:
+        if mode == "r":
+            process = subprocess.Popen(command + ["-dc", fastq_file], stdout=subprocess.PIPE)
+            handle = io.TextIOWrapper(process.stdout)
+        else:
+            out = open(fastq_file, "wb")
+            process = subprocess.Popen(command + ["-c"], stdin=subprocess.PIPE, stdout=out)
+            handle = io.TextIOWrapper(process.stdin)
+        try:
+            yield handle
+        finally:
+            handle.close()
+            returncode = process.wait()
+            if mode != "r":
+                out.close()
+        if returncode != 0:
+            raise IOError(f"{command[0]} failed on {fastq_file}")
+    elif compression == "gzip":
+        with gzip.open(fastq_file, mode + "t") as f:
+            yield f
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise IOError(f"Reading {fastq_file} needs the zstd command line tool or the zstandard python package")
+        with zstandard.open(fastq_file, mode + "t") as f:
+            yield f
+
+def read_fastq(fastq_file, threads=1):
+    """Yield (name, seq, qual) strings from a four line fastq file.
+
+    The name is the whole header line without the leading '@'."""
+    with open_fastq(fastq_file, "r", threads) as f:
+        lines = iter(f)
+        for header in lines:
+            seq = next(lines, "")
+            plus = next(lines, "")
+            qual = next(lines, "")
+            if not header.startswith("@") or not plus.startswith("+"):
+                raise ValueError(f"Malformed fastq record in {fastq_file}: {header.rstrip()}")
+            yield header[1:].rstrip("\r\n"), seq.rstrip("\r\n"), qual.rstrip("\r\n")
+
+def read_fastq_seqs(fastq_file, threads=1):
+    for name, seq, qual in read_fastq(fastq_file, threads):
+        yield seq
+
+def filter_read_lengths(read_seqs, min_length=0, max_length=None, length_counts=None):
+    """Yield the sequences with min_length < length < max_length, tallying
+    rejects in length_counts."""
+    if length_counts is None:
+        length_counts = Counter()
+    for seq in read_seqs:
+        length = len(seq)
+        if length <= min_length:
+            length_counts["too_short"] += 1
+        elif max_length is not None and length >= max_length:
+            length_counts["too_long"] += 1
+        else:
+            length_counts["passed"] += 1
+            yield seq
+
+def read_length_filtered_seqs(fastq_files, min_length=0, max_length=None, length_counts=None, threads=1):
+    """Yield the sequences of every read in fastq_files with
+    min_length < length < max_length, tallying rejects in length_counts."""
+    for fastq_file in fastq_files:
+        yield from filter_read_lengths(read_fastq_seqs(fastq_file, threads), min_length, max_length, length_counts)
+
+def chunk_reads(reads, chunk_size):
+    reads = iter(reads)
+    while True:
+        chunk = list(itertools.islice(reads, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def imap_bounded(pool, function, iterable, window):
+    # unlike pool.imap, only window chunks are read ahead of the results,
+    # so memory stays bounded and reading stops as soon as the caller does
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def count_reads(fastq_file, threads=1):
+    with open_fastq(fastq_file, "r", threads) as f:
+        line_count = sum(1 for line in f)
+    return line_count // 4
+
+def filter_fastq_by_length(fastq_file, min_length, max_length, length_counts=None):
+    """Length-only fast path for the read length filter. Yields the raw text
+    of every record with min_length < length < max_length, without splitting
+    it into fields. Rejected reads are tallied in length_counts if given."""
+    if length_counts is None:
+        length_counts = Counter()
+    with open_fastq(fastq_file, "r") as f:
+        lines = iter(f)
+        for header in lines:
+            seq = next(lines, "")
+            plus = next(lines, "")
+            qual = next(lines, "")
+            length = len(seq.rstrip("\r\n"))
+            if length <= min_length:
+                length_counts["too_short"] += 1
+            elif length >= max_length:
+                length_counts["too_long"] += 1
+            else:
+                length_counts["passed"] += 1
+                yield header + seq + plus + qual
+
+def write_length_filtered_reads(fastq_files, fw, min_length, max_length, buffer_size=10000):
+    """Stream reads from fastq_files through the length filter into fw,
+    holding at most buffer_size records in memory at a time."""
+    length_counts = Counter()
+    buffer = []
+    for fastq_file in fastq_files:
+        for record in filter_fastq_by_length(fastq_file, min_length, max_length, length_counts):
+            buffer.append(record)
+            if len(buffer) >= buffer_size:
+                fw.write("".join(buffer))
+                buffer = []
+    fw.write("".join(buffer))
+    return length_counts
+
+def is_fastq(filename):
+    name = filename.lower()
+    for extension in COMPRESSION_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith(FASTQ_EXTENSIONS)
+
+def get_fastq_files(read_paths):
+    """Expand a list of fastq files and directories of fastq files."""
+    fastq_files = []
+    for path in read_paths:
+        if os.path.isdir(path):
+            fastq_files.extend(find_fastq_files(path))
+        else:
+            fastq_files.append(path)
+    return fastq_files
+
+def get_file_fingerprint(path):
+    """Path, size and modification time of a file, which change whenever
+    the file is replaced or appended to."""
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+def find_fastq_files(path):
+    fastq_files = []
+    for r,d,f in os.walk(path):
+        for fn in f:
+            if is_fastq(fn):
+                fastq_files.append(os.path.join(r, fn))
+    return fastq_files
+
+def has_fastq_files(path):
+    for r,d,f in os.walk(path):
+        for fn in f:
+            if is_fastq(fn):
+                return True
+    return False
+
+def make_read_manifest(read_path, previous=None, with_read_counts=False, threads=1):
+    """Scan read_path once, listing the fastq files in each barcode directory
+    with their size, mtime and, if with_read_counts, number of reads. Read
+    counts are taken from a previous manifest for files that have not changed,
+    so only new files are counted."""
+    known = {}
+    if previous:
+        for barcode in previous:
+            for entry in previous[barcode]:
+                known[entry["path"]] = entry
+
+    manifest = {}
+    for r,d,f in os.walk(read_path):
+        for name in d:
+            if name.startswith("barcode"):
+                manifest.setdefault(name, [])
+        # files are counted for the barcode directory directly under read_path
+        barcode = os.path.relpath(r, read_path).split(os.sep)[0]
+        if not barcode.startswith("barcode"):
+            continue
+        for fn in f:
+            if not is_fastq(fn):
+                continue
+            fastq_file = os.path.join(r, fn)
+            try:
+                stat = os.stat(fastq_file)
+            except FileNotFoundError:
+                continue
+            entry = {"path": fastq_file, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "reads": None}
+            previous_entry = known.get(fastq_file)
+            if previous_entry and previous_entry["size"] == entry["size"] and previous_entry["mtime_ns"] == entry["mtime_ns"]:
+                entry["reads"] = previous_entry["reads"]
+            if with_read_counts and entry["reads"] is None:
+                entry["reads"] = count_reads(fastq_file, threads)
+            manifest[barcode].append(entry)
+    return manifest
+
+def load_read_manifest(manifest_dir, barcodes=None):
+    """Load the manifest entries of the given barcodes, or of every barcode,
+    from manifest_dir. Each barcode is kept in its own file so a job only
+    reads the files of its own barcode."""
+    if not os.path.isdir(manifest_dir):
+        return None
+    if barcodes is None:
+        barcodes = [fn[:-len(".json")] for fn in os.listdir(manifest_dir) if fn.endswith(".json")]
+    manifest = {}
+    for barcode in barcodes:
+        with open(os.path.join(manifest_dir, f"{barcode}.json"), "r") as f:
+            manifest[barcode] = json.load(f)
+    return manifest
+
+def write_read_manifest(manifest_dir, manifest):
+    os.makedirs(manifest_dir, exist_ok=True)
+    for barcode in manifest:
+        manifest_file = os.path.join(manifest_dir, f"{barcode}.json")
+        with open(manifest_file + ".tmp", "w") as fw:
+            fw.write(json.dumps(manifest[barcode]))
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+def get_manifest_files(manifest, barcode):
+    return [entry["path"] for entry in manifest.get(barcode, [])]
@@ -4,200 +4,832 @@ import argparse
 import os
 import sys
 import csv
+import json
+import hashlib
+import math
+import sqlite3
 from collections import Counter
 import collections
+import itertools
+import multiprocessing
+import contextlib
+import re
+import numpy as np
 import parasail
-from Bio import SeqIO
-from Bio import Seq
+
+import fastqfunks
+import referencefunks
 
 def parse_args():
     parser = argparse.ArgumentParser(description='ParaMethR')
 
-    parser.add_argument("--reads", action="store", type=str, dest="reads")
+    parser.add_argument("--reads", action="store", nargs="+", type=str, dest="reads",
+                        help="Fastq files, or barcode directories of fastq files")
+    parser.add_argument("--read-manifest", action="store", type=str, dest="read_manifest",
+                        help="Read manifest directory written by the pipeline, count the fastq files it lists for --sample instead of --reads")
     parser.add_argument("--references", action="store", type=str, dest="references")
     parser.add_argument("--cpg_csv", action="store", type=str, dest="cpg_csv")
     parser.add_argument("--cpg-header",action="store",type=str,dest="cpg_header")
     parser.add_argument("--substitution_matrix", action="store", type=str, dest="substitution_matrix")
+    parser.add_argument("--bundle", action="store", type=str, dest="bundle",
+                        help="Reference bundle compiled by apollo build-reference, rebuilt here if the data files have changed")
     parser.add_argument("--report", action="store", type=str, dest="report")
     parser.add_argument("--sample", action="store", type=str, dest="sample")
     parser.add_argument("--counts", action="store", type=str, dest="counts")
+    parser.add_argument("--min-length", action="store", type=int, dest="min_length", default=0)
+    parser.add_argument("--max-length", action="store", type=int, dest="max_length")
+    parser.add_argument("--threads", action="store", type=int, dest="threads", default=1)
+    parser.add_argument("--chunk-size", action="store", type=int, dest="chunk_size", default=1000)
+    parser.add_argument("--primers", action="store", type=str, dest="primers",
+                        help="Csv of gene,forward primer,reverse primer used to route reads before aligning")
+    parser.add_argument("--primer-search-length", action="store", type=int, dest="primer_search_length", default=150,
+                        help="Number of bases at each end of a read to search for the primers")
+    parser.add_argument("--kmer-size", action="store", type=int, dest="kmer_size", default=12)
+    parser.add_argument("--candidates", action="store", type=int, dest="candidates", default=2)
+    parser.add_argument("--shard", action="store", type=int, dest="shard", default=0,
+                        help="Only count every --shards'th read, starting from this one")
+    parser.add_argument("--shards", action="store", type=int, dest="shards", default=1)
+    parser.add_argument("--partials-dir", action="store", type=str, dest="partials_dir",
+                        help="Keep per-file partial counts here and reuse them for files that have not changed")
+    parser.add_argument("--cache-dir", action="store", type=str, dest="cache_dir",
+                        help="Keep the site calls of every aligned read here, so reanalysing the same reads skips alignment")
+    parser.add_argument("--cache-size", action="store", type=int, dest="cache_size",
+                        help="Number of recent reads each process keeps in memory to skip aligning duplicate reads. "
+                        f"Default: {CACHE_SIZE} with --cache-dir, otherwise 0 (off)")
+    parser.add_argument("--target-coverage", action="store", type=int, dest="target_coverage", default=0,
+                        help="Stop counting once every site in --cpg-header has this many C+T reads")
+    parser.add_argument("--target-ci-width", action="store", type=float, dest="target_ci_width", default=0,
+                        help="Stop counting once the 95%% confidence interval of every site's methylation is narrower than this")
+    parser.add_argument("--merge-counts", action="store", nargs="+", type=str, dest="merge_counts",
+                        help="Sum the raw site counts of these cpg_counts files instead of counting reads")
 
     return parser.parse_args()
 
-def get_best_reference(query, ref_dict, matrix):
+# reads are bisulfite converted, so k-mers are compared in a three letter alphabet:
+# C/Y collapse onto T for the forward references and G/R onto A for the reverse ones
+CONVERSIONS = {
+    "forward": str.maketrans("CY", "TT"),
+    "reverse": str.maketrans("GR", "AA")
+}
+
+def make_kmer_index(ref_dict, kmer_size=12):
+    kmer_index = {"forward": collections.defaultdict(list), "reverse": collections.defaultdict(list)}
+    for ref in ref_dict:
+        direction = ref.rsplit("_",1)[1]
+        converted = ref_dict[ref].upper().translate(CONVERSIONS[direction])
+        kmers = set(converted[i:i+kmer_size] for i in range(len(converted) - kmer_size + 1))
+        for kmer in kmers:
+            kmer_index[direction][kmer].append(ref)
+    return kmer_index
+
+def get_candidate_references(query, kmer_index, kmer_size=12, max_candidates=2):
+    hits = Counter()
+    for direction in kmer_index:
+        converted = query.translate(CONVERSIONS[direction])
+        direction_index = kmer_index[direction]
+        for i in range(len(converted) - kmer_size + 1):
+            kmer = converted[i:i+kmer_size]
+            if kmer in direction_index:
+                hits.update(direction_index[kmer])
+    return [ref for ref,count in hits.most_common(max_candidates)]
+
+# primers are compared by edit distance in the same three letter alphabet as the
+# k-mers, with free gaps in the read so that the whole primer has to align
+PRIMER_MATRIX = parasail.matrix_create("ACGTN", 0, -1)
+PRIMER_MAX_ERROR_RATE = 0.2
+NON_ACGT = str.maketrans("RYKMSWBDHV", "NNNNNNNNNN")
+
+def convert_primer(primer, direction="forward"):
+    return primer.upper().translate(CONVERSIONS[direction]).translate(NON_ACGT)
+
+def place_primer(primer, reference):
+    # the primer csvs don't agree on which strand the reverse primer is written
+    # on, so it is turned whichever way best matches either converted strand
+    placements = []
+    for oriented in [primer, referencefunks.reverse_complement(primer)]:
+        for direction in CONVERSIONS:
+            result = parasail.sg_dx_scan_16(convert_primer(oriented, direction), convert_primer(reference, direction), 1, 1, PRIMER_MATRIX)
+            placements.append((-result.score, result.end_ref, oriented))
+    errors, end, oriented = min(placements)
+    return oriented
+
+def load_primer_anchors(primer_csv, references):
+    """Orient the two primers of every amplicon onto its forward reference. The
+    start anchor is the forward primer, read at the start of a forward strand
+    read, and the end anchor the reverse primer as read at its end."""
+    primer_anchors = {}
+    if not primer_csv or not os.path.exists(primer_csv):
+        return primer_anchors
+    with open(primer_csv, "r") as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0].lower() + "_forward" not in references:
+                continue
+            gene = row[0].lower()
+            reference = references[gene + "_forward"]
+            primer_anchors[gene] = {
+                "start": place_primer(row[1].strip(), reference),
+                "end": place_primer(row[2].strip(), reference)
+            }
+    return primer_anchors
+
+def make_primer_profiles(primer_anchors):
+    primer_profiles = {}
+    for gene in primer_anchors:
+        primer_profiles[gene] = {}
+        for anchor in primer_anchors[gene]:
+            primer = convert_primer(primer_anchors[gene][anchor])
+            primer_profiles[gene][anchor] = (parasail.profile_create_16(primer, PRIMER_MATRIX), len(primer))
+    return primer_profiles
+
+def match_primer(primer_profile, window):
+    profile, length = primer_profile
+    result = parasail.sg_dx_scan_profile_16(profile, window, 1, 1)
+    errors = -result.score
+    if errors > length * PRIMER_MAX_ERROR_RATE:
+        return None
+    return errors, result.end_ref
+
+def route_read(read_seq, primer_profiles, search_length=150):
+    """Assign a read to an amplicon from the primer at its start. Returns the
+    forward reference id and the read turned onto the forward strand and
+    trimmed to its primers, or None when no single primer matches."""
+    matches = []
+    for oriented in [read_seq, referencefunks.reverse_complement(read_seq)]:
+        window = oriented[:search_length].translate(CONVERSIONS["forward"])
+        for gene in primer_profiles:
+            match = match_primer(primer_profiles[gene]["start"], window)
+            if match:
+                errors, end = match
+                matches.append((errors, gene, oriented, end + 1 - primer_profiles[gene]["start"][1]))
+    matches.sort(key=lambda match: match[0])
+    if not matches or (len(matches) > 1 and matches[1][0] == matches[0][0]):
+        return None
+    errors, gene, oriented, start = matches[0]
+
+    # anything past the end primer (adapter and barcode) is trimmed too, if it is found
+    end = len(oriented)
+    tail_start = max(0, len(oriented) - search_length)
+    match = match_primer(primer_profiles[gene]["end"], oriented[tail_start:].translate(CONVERSIONS["forward"]))
+    if match:
+        end = tail_start + match[1] + 1
+
+    # a few bases are kept either side in case insertions moved the primer ends
+    slack = int(primer_profiles[gene]["start"][1] * PRIMER_MAX_ERROR_RATE)
+    return gene + "_forward", oriented[max(0, start - slack):end + slack]
+
+# striped kernels by lane width, with the largest score or alignment length each can hold.
+# The _sat kernels start at 8 bits and rerun at 16 when a lane overflows, which
+# every amplicon length read does, so the width is picked up front instead
+KERNEL_LIMITS = {8: 127, 16: 32767, 32: 2147483647}
+STATS_KERNELS = {
+    8: (parasail.profile_create_stats_8, parasail.sw_stats_striped_profile_8),
+    16: (parasail.profile_create_stats_16, parasail.sw_stats_striped_profile_16),
+    32: (parasail.profile_create_stats_32, parasail.sw_stats_striped_profile_32)
+}
+TRACE_KERNELS = {
+    8: parasail.sw_trace_striped_8,
+    16: parasail.sw_trace_striped_16,
+    32: parasail.sw_trace_striped_32
+}
+
+def get_kernel_width(query_length, reference_length, matrix):
+    # stats kernels also count matches and alignment length in the same lanes
+    largest = max(matrix.max * min(query_length, reference_length), query_length + reference_length)
+    for width in KERNEL_LIMITS:
+        if largest <= KERNEL_LIMITS[width]:
+            return width
+    return 32
+
+def get_best_reference(query, ref_dict, matrix, gap_open=3, gap_extension=2, candidates=None):
     best_reference_alignment = {
         "reference": "None_NA",
         "identity": 0,
         "coverage": 0
         }
-    for ref in ref_dict:
-        
-        new_reference_alignment = align_read(query, ref, ref_dict[ref], matrix)
-        if new_reference_alignment["coverage"] > 0.7:
-            
-            if best_reference_alignment["identity"] < new_reference_alignment["identity"]: 
-                best_reference_alignment = new_reference_alignment
-            else:
-                pass
+    if candidates is None:
+        candidates = ref_dict
+    if not candidates:
+        return best_reference_alignment
+
+    # the query profile is built once and reused against every candidate
+    width = get_kernel_width(len(query), max(len(ref_dict[ref]) for ref in candidates), matrix)
+    create_profile, stats_kernel = STATS_KERNELS[width]
+    profile = create_profile(query, matrix)
+    for ref in candidates:
+        # candidates are ranked on the stats kernel alone, the traceback is
+        # only computed once for the winner in process_reads
+        result_stats = stats_kernel(profile, ref_dict[ref], gap_open, gap_extension)
+        alignment_covers = int(result_stats.length) / len(ref_dict[ref])
+        if alignment_covers > 0.7:
+            identity = result_stats.matches / result_stats.len_ref
+            if best_reference_alignment["identity"] < identity:
+                best_reference_alignment = {
+                    "reference": ref,
+                    "matches": result_stats.matches,
+                    "coverage": alignment_covers,
+                    "aln_len": result_stats.length,
+                    "len": result_stats.len_ref,
+                    "identity": identity
+                }
     return best_reference_alignment
 
+CIGAR_PATTERN = re.compile(r"(\d+)([=XMID])")
+
 def align_read(query, ref_id, reference, matrix, gap_open=3, gap_extension=2):
-    result_trace = None
-    traceback = None
-    result_trace = parasail.sw_trace_striped_sat(query, reference, gap_open, gap_extension, matrix)
-    traceback = result_trace.get_traceback('|', '.', ' ')
-
-    query_start = result_trace.cigar.beg_query
-    reference_start = result_trace.cigar.beg_ref
-    result_stats = None
-    result_stats = parasail.sw_stats_striped_sat(query, reference, gap_open, gap_extension, matrix)
-    alignment_covers = int(result_stats.length) / len(reference)
+    trace_kernel = TRACE_KERNELS[get_kernel_width(len(query), len(reference), matrix)]
+    result_trace = trace_kernel(query, reference, gap_open, gap_extension, matrix)
+    cigar = result_trace.cigar
+
+    operations = [(int(length), op) for length, op in CIGAR_PATTERN.findall(cigar.decode.decode())]
+
+    # the cigar can open with gap operations, which only move the start of the alignment
+    query_start = cigar.beg_query
+    reference_start = cigar.beg_ref
+    while operations and operations[0][1] in "ID":
+        length, op = operations.pop(0)
+        if op == "I":
+            query_start += length
+        else:
+            reference_start += length
+
+    # one query base (or '-') for every reference position covered by the alignment
+    query_bases = []
+    query_index = query_start
+    for length, op in operations:
+        if op == "I":
+            query_index += length
+        elif op == "D":
+            query_bases.extend("-" * length)
+        else:
+            query_bases.extend(query[query_index:query_index + length])
+            query_index += length
+
     return {
             "reference":ref_id,
             "query_start": query_start,
             "reference_start": reference_start,
-            "matches": result_stats.matches,
-            "coverage": alignment_covers,
-            "aln_len": result_stats.length,
-            "len": result_stats.len_ref,
-            "identity": result_stats.matches / result_stats.len_ref,
-            "ref": traceback.ref,
-            "comp": traceback.comp,
-            "query": traceback.query
+            "aln_len": len(query_bases),
+            "query_bases": query_bases
         }
 
-def process_file(reads,references,cpg_dict,sample,cpg_counter,nuc_matrix):
+# columns of the per-site count matrix, anything else (including sites the
+# alignment doesn't reach) is counted as other
+BASE_COLUMNS = {"A": 0, "C": 1, "G": 2, "T": 3, "-": 4}
+OTHER_COLUMN = 5
+N_COLUMNS = 6
 
-    
-    counts = Counter()
+# sites with fewer C+T reads than this are reported as NA
+MIN_COVERAGE = 50
 
-    for record in SeqIO.parse(reads, "fastq"):
+# bumped whenever what is kept for each read or file changes, so partial counts
+# and alignment caches written by older versions are not reused
+COUNTS_VERSION = 2
 
-        stats = get_best_reference(str(record.seq), references, nuc_matrix)
-        best_ref,direction = stats["reference"].split("_")
-        
-        background_error_rate = get_background_error_rate(stats)
+def count_read(read_seq,references,cpg_dict,nuc_matrix,kmer_index=None,kmer_size=12,max_candidates=2,
+                primer_profiles=None,primer_search_length=150):
+    """Align one read, returning the gene it was assigned to (or "None"), the
+    flat count matrix index of the base it has at each of that gene's sites and
+    its background counts from get_background_counts."""
 
-        alignment_covers = int(stats["aln_len"]) / int(stats["len"]) # doesn't account for gaps so can be > 1
+    # reads routed by their primer are only checked against that one amplicon
+    routed = None
+    if primer_profiles:
+        routed = route_read(read_seq, primer_profiles, primer_search_length)
 
-        if stats["identity"] > 0.75:
+    candidates = None
+    if routed:
+        ref_id, read_seq = routed
+        candidates = [ref_id]
+    elif kmer_index is not None:
+        candidates = get_candidate_references(read_seq, kmer_index, kmer_size, max_candidates)
+        if not candidates:
+            return "None", [], (0, 0)
 
-            read_seq = ''
-            if direction == "forward":
-                read_seq = str(record.seq)
-            else:
-                read_seq = str(record.seq.reverse_complement())
-            ref_seq = references[best_ref + "_forward"]
+    stats = get_best_reference(read_seq, references, nuc_matrix, candidates=candidates)
 
-            alignment = align_read(read_seq, best_ref, ref_seq, nuc_matrix)
-            for site in cpg_dict[best_ref]:
-                read_variant = get_site(site[1],alignment)
-                
-                cpg_counter[site[0]][read_variant]+=1
+    if stats["identity"] <= 0.75:
+        return "None", [], (0, 0)
 
-            counts[best_ref]+=1
+    best_ref,direction = stats["reference"].rsplit("_",1)
 
-        else:
-            counts["None"]+=1
+    # the single traceback is taken against the forward reference so that
+    # reverse reads share the gap placement of forward reads at each site
+    if direction == "reverse":
+        read_seq = referencefunks.reverse_complement(read_seq)
+    ref_seq = references[best_ref + "_forward"]
 
-    return counts, cpg_counter
+    alignment = align_read(read_seq, best_ref, ref_seq, nuc_matrix)
+    sites = cpg_dict[best_ref]
+    site_counts = []
+    for site, read_variant in zip(sites, get_sites(sites, alignment)):
+        site_counts.append(site[2] * N_COLUMNS + BASE_COLUMNS.get(read_variant, OTHER_COLUMN))
 
+    return best_ref, site_counts, get_background_counts(alignment, ref_seq)
 
-def get_background_error_rate(stats):
+def process_reads(read_seqs,references,cpg_dict,cpg_counter,nuc_matrix,kmer_index=None,kmer_size=12,max_candidates=2,
+                    primer_profiles=None,primer_search_length=150,cache=None):
 
+    counts = Counter()
+    site_counts = []
+    background = Counter()
+
+    for read_seq in read_seqs:
+        result = None
+        if cache is not None:
+            result = cache.get(read_seq)
+        if result is None:
+            result = count_read(read_seq, references, cpg_dict, nuc_matrix, kmer_index, kmer_size, max_candidates,
+                                primer_profiles, primer_search_length)
+            if cache is not None:
+                cache.put(read_seq, result)
+
+        best_ref, read_site_counts, (t_count, c_count) = result
+        counts[best_ref]+=1
+        site_counts.extend(read_site_counts)
+        background["T"] += t_count
+        background["C"] += c_count
+
+    if site_counts:
+        cpg_counter += np.bincount(site_counts, minlength=cpg_counter.size).reshape(cpg_counter.shape)
+
+    return counts, cpg_counter, background
+
+# reads kept in memory by each process when the cache is on. Reads with
+# nanopore error rates rarely repeat exactly, so it only pays off when the
+# same reads are counted again, and is off by default without a cache dir
+CACHE_SIZE = 100000
+
+class AlignmentCache():
+    """Results of count_read keyed by read sequence. Recent reads are kept in
+    memory and, given a cache file, all reads are looked up on disk too. New
+    results are only collected here, the main process writes them to disk."""
+
+    def __init__(self, size=CACHE_SIZE, cache_file=None):
+        self.size = size
+        self.memory = collections.OrderedDict()
+        self.db = None
+        if cache_file:
+            self.db = sqlite3.connect(f"file:{cache_file}?mode=ro", uri=True, timeout=60)
+        self.new_entries = []
+        self.stats = Counter()
+
+    def get(self, read_seq):
+        if read_seq in self.memory:
+            self.memory.move_to_end(read_seq)
+            self.stats["memory"] += 1
+            return self.memory[read_seq]
+        if self.db is not None:
+            row = self.db.execute("SELECT reference, sites, background_t, background_c FROM alignments WHERE read = ?", (get_read_key(read_seq),)).fetchone()
+            if row:
+                result = (row[0], np.frombuffer(row[1], dtype=np.int32).tolist(), (row[2], row[3]))
+                self.stats["disk"] += 1
+                self.remember(read_seq, result)
+                return result
+        self.stats["miss"] += 1
+        return None
+
+    def put(self, read_seq, result):
+        self.remember(read_seq, result)
+        if self.db is not None:
+            self.new_entries.append((get_read_key(read_seq), result[0], np.array(result[1], dtype=np.int32).tobytes()) + tuple(result[2]))
+
+    def remember(self, read_seq, result):
+        if self.size:
+            self.memory[read_seq] = result
+            if len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def take_updates(self):
+        stats, new_entries = self.stats, self.new_entries
+        self.stats, self.new_entries = Counter(), []
+        return stats, new_entries
+
+def get_read_key(read_seq):
+    return hashlib.sha1(read_seq.encode()).digest()
+
+def open_cache_db(cache_file):
+    # write ahead logging lets the worker processes read while new results are written
+    db = sqlite3.connect(cache_file, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS alignments (read BLOB PRIMARY KEY, reference TEXT, sites BLOB, background_t INTEGER, background_c INTEGER)")
+    db.commit()
+    return db
+
+def write_cache_entries(db, new_entries):
+    if new_entries:
+        db.executemany("INSERT OR IGNORE INTO alignments VALUES (?, ?, ?, ?, ?)", new_entries)
+        db.commit()
+
+# each worker process unpacks its own references, index and parasail matrix once,
+# in serial mode the same data is unpacked into this process
+worker_data = {}
+
+def init_worker(bundle, kmer_size, max_candidates, primer_routing=False, primer_search_length=150,
+                cache_size=0, cache_file=None):
+    worker_data["cache"] = None
+    if cache_size or cache_file:
+        worker_data["cache"] = AlignmentCache(cache_size, cache_file)
+    worker_data["references"] = bundle["references"]
+    worker_data["primer_profiles"] = make_primer_profiles(bundle["primer_anchors"]) if primer_routing else {}
+    worker_data["primer_search_length"] = primer_search_length
+    worker_data["cpg_dict"] = collections.defaultdict(list)
+    for gene, name, position, site_id in bundle["cpg_sites"]:
+        worker_data["cpg_dict"][gene].append((name, position, site_id))
+    worker_data["n_sites"] = len(set(site[1] for site in bundle["cpg_sites"]))
+    worker_data["nuc_matrix"] = make_nuc_matrix(bundle["matrix"])
+    worker_data["kmer_index"] = None
+    if kmer_size:
+        worker_data["kmer_index"] = make_kmer_index(worker_data["references"], kmer_size)
+    worker_data["kmer_size"] = kmer_size
+    worker_data["max_candidates"] = max_candidates
+
+def process_chunk(file_chunk):
+    file_index, read_seqs = file_chunk
+    cpg_counter = np.zeros((worker_data["n_sites"], N_COLUMNS), dtype=np.int64)
+    counts, cpg_counter, background = process_reads(read_seqs, worker_data["references"], worker_data["cpg_dict"], cpg_counter, worker_data["nuc_matrix"],
+                                        worker_data["kmer_index"], worker_data["kmer_size"], worker_data["max_candidates"],
+                                        worker_data["primer_profiles"], worker_data["primer_search_length"], worker_data["cache"])
+    cache_stats, new_entries = Counter(), []
+    if worker_data["cache"] is not None:
+        cache_stats, new_entries = worker_data["cache"].take_updates()
+    return file_index, counts, cpg_counter, background, cache_stats, new_entries
+
+@contextlib.contextmanager
+def worker_map(threads, init_args):
+    """Yield a map function that runs process_chunk over a pool of threads
+    worker processes, or in this process when threads is 1."""
+    if threads > 1:
+        with multiprocessing.Pool(threads, initializer=init_worker, initargs=init_args) as pool:
+            yield lambda function, iterable: fastqfunks.imap_bounded(pool, function, iterable, threads * 2)
+    else:
+        init_worker(*init_args)
+        yield map
+
+def chunk_read_sets(read_sets, chunk_size, min_length, max_length, length_counts, shard=0, shards=1):
+    # chunks never span two read sets so that counts can be kept per file
+    for file_index, read_seqs in enumerate(read_sets):
+        read_seqs = fastqfunks.filter_read_lengths(read_seqs, min_length, max_length, length_counts[file_index])
+        if shards > 1:
+            read_seqs = itertools.islice(read_seqs, shard, None, shards)
+        for chunk in fastqfunks.chunk_reads(read_seqs, chunk_size):
+            yield file_index, chunk
+
+def process_fastq_files(fastq_files, n_sites, map_function=map, chunk_size=1000, min_length=0, max_length=None, shard=0, shards=1, threads=1,
+                        coverage_reached=None, cache_db=None):
+    """Count the reads of every fastq file, returning a process_read_sets
+    result for each file."""
+    read_sets = [fastqfunks.read_fastq_seqs(fastq_file, threads) for fastq_file in fastq_files]
+    return process_read_sets(read_sets, n_sites, map_function, chunk_size, min_length, max_length, shard, shards,
+                                coverage_reached, cache_db)
+
+def process_read_sets(read_sets, n_sites, map_function=map, chunk_size=1000, min_length=0, max_length=None, shard=0, shards=1,
+                        coverage_reached=None, cache_db=None):
+    """Count every iterable of read sequences in read_sets, returning the
+    reference, site, read length and background counts of each. map_function
+    runs process_chunk, either in this process or over a worker pool.
+
+    If given, coverage_reached is checked on the running site counts after every
+    chunk, in read order, and the remaining reads are only tallied as skipped once
+    it is true. That includes the chunks a worker pool was already counting, so
+    where a run stops doesn't depend on the number of threads.
+    New alignment cache results from the workers are written to cache_db."""
+    file_results = []
+    for read_seqs in read_sets:
+        file_results.append({
+            "counts": Counter(),
+            "cpg_counts": np.zeros((n_sites, N_COLUMNS), dtype=np.int64),
+            "length_counts": Counter(),
+            "background": Counter(),
+            "cache_stats": Counter(),
+            "skipped": 0
+        })
+    total_cpg_counts = np.zeros((n_sites, N_COLUMNS), dtype=np.int64)
+    stopped = coverage_reached is not None and coverage_reached(total_cpg_counts)
+
+    def take_chunks(file_chunks):
+        for file_index, chunk in file_chunks:
+            if stopped:
+                file_results[file_index]["skipped"] += len(chunk)
+            else:
+                yield file_index, chunk
+
+    length_counts = [file_result["length_counts"] for file_result in file_results]
+    file_chunks = chunk_read_sets(read_sets, chunk_size, min_length, max_length, length_counts, shard, shards)
+    for file_index, chunk_counts, chunk_cpg_counter, background, cache_stats, new_entries in map_function(process_chunk, take_chunks(file_chunks)):
+        if cache_db is not None:
+            write_cache_entries(cache_db, new_entries)
+        if stopped:
+            file_results[file_index]["skipped"] += sum(chunk_counts.values())
+            continue
+        file_results[file_index]["counts"].update(chunk_counts)
+        file_results[file_index]["background"].update(background)
+        file_results[file_index]["cache_stats"].update(cache_stats)
+        file_results[file_index]["cpg_counts"] += chunk_cpg_counter
+        if coverage_reached is not None:
+            total_cpg_counts += chunk_cpg_counter
+            stopped = coverage_reached(total_cpg_counts)
+
+    return file_results
+
+def get_ci_width(c, n, z=1.96):
+    # width of the Wilson score interval for a proportion of c out of n
+    p = c / n
+    return 2 * z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+
+def coverage_target_reached(cpg_counts, site_ids, target_coverage=0, target_ci_width=0):
+    site_counts = cpg_counts[site_ids]
+    c = site_counts[:, BASE_COLUMNS["C"]]
+    c_and_t = c + site_counts[:, BASE_COLUMNS["T"]]
+    if target_coverage and np.all(c_and_t >= target_coverage):
+        return True
+    # the interval is only trusted once every site would be reported rather than NA
+    if target_ci_width and np.all(c_and_t > MIN_COVERAGE):
+        return bool(np.all(get_ci_width(c, c_and_t) <= target_ci_width))
+    return False
+
+def get_settings_fingerprint(file_paths, settings):
+    fingerprint = hashlib.sha1()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            fingerprint.update(f.read())
+    fingerprint.update(json.dumps(settings, sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+def get_partial_file(partials_dir, fastq_file, settings_fingerprint, shard=0, shards=1):
+    file_key = f"{fastqfunks.get_file_fingerprint(fastq_file)}\t{shard}/{shards}\t{settings_fingerprint}"
+    return os.path.join(partials_dir, hashlib.sha1(file_key.encode()).hexdigest() + ".json")
+
+def load_partial(partial_file):
+    with open(partial_file, "r") as f:
+        partial = json.load(f)
+    return {
+        "counts": Counter(partial["counts"]),
+        "cpg_counts": np.array(partial["cpg_counts"], dtype=np.int64),
+        "length_counts": Counter(partial["length_counts"]),
+        "background": Counter(partial["background"])
+    }
+
+def write_partial(partial_file, file_result):
+    # written to a temporary name first so an interrupted run never leaves a truncated partial
+    with open(partial_file + ".tmp", "w") as fw:
+        json.dump({
+            "counts": file_result["counts"],
+            "cpg_counts": file_result["cpg_counts"].tolist(),
+            "length_counts": file_result["length_counts"],
+            "background": file_result["background"]
+        }, fw)
+    os.replace(partial_file + ".tmp", partial_file)
+
+
+def get_background_counts(alignment, reference):
+    # every C outside a CpG is a T in the converted reference, so a C read at any
+    # reference T is either unconverted or a sequencing error
     T_count = 0
     C_count = 0
-    for i in range(int(stats["aln_len"])):
-        if stats["ref"][i] == "T":
+    aligned_ref = reference[alignment["reference_start"]:alignment["reference_start"] + alignment["aln_len"]]
+    for ref_base, query_base in zip(aligned_ref, alignment["query_bases"]):
+        if ref_base == "T":
             T_count +=1
-            if stats["query"][i] == 'C':
+            if query_base == 'C':
                 C_count +=1
 
-    return C_count/T_count 
-
-def get_site(cpg_index, stats):
-    adjusted_index = cpg_index - stats["reference_start"]
-    current_index = 0
+    return T_count, C_count
 
-    variant = ""
-    for i in range(int(stats["aln_len"])):
-        if adjusted_index == current_index:
-            variant = stats["query"][i]
+def get_background_error_rate(background):
+    if not background["T"]:
+        return None
+    return background["C"] / background["T"]
 
-        if stats["ref"][i] != '-':
-            current_index +=1
+def get_sites(sites, alignment):
+    reference_start = alignment["reference_start"]
+    query_bases = alignment["query_bases"]
 
-    return variant
+    variants = []
+    for site in sites:
+        adjusted_index = site[1] - reference_start
+        if 0 <= adjusted_index < len(query_bases):
+            variants.append(query_bases[adjusted_index])
+        else:
+            variants.append("")
+    return variants
 
 def load_cpg_dict(cpg_csv):
+    # each site carries its row in the count matrix as an integer id
     cpg_dict= collections.defaultdict(list)
     with open(cpg_csv,"r") as f:
         cpg_file = csv.DictReader(f)
-        for row in cpg_file:
+        for site_id,row in enumerate(cpg_file):
             position = int(row["position"]) - 1
-            cpg_dict[row["gene"].lower()].append((row["gene"].lower()+ "_" + row["position"],position))
+            cpg_dict[row["gene"].lower()].append((row["gene"].lower()+ "_" + row["position"],position,site_id))
     return cpg_dict
 
-def make_cpg_counter(cpg_csv):
-    cpg_counts= {}
+def load_cpg_ids(cpg_csv):
+    cpg_ids = {}
     with open(str(cpg_csv),"r") as f:
         cpg_file = csv.DictReader(f)
-        for row in cpg_file:
-            cpg_counts[row["gene"].lower()+ "_" + row["position"]] = Counter()
-    return cpg_counts
-
-def load_reference_dict(ref_file):
+        for site_id,row in enumerate(cpg_file):
+            cpg_ids[row["gene"].lower()+ "_" + row["position"]] = site_id
+    return cpg_ids
 
-    references = {}
-    for record in SeqIO.parse(ref_file, "fasta"):
-        lower_id = str(record.id).lower()
-        references[lower_id+ "_forward"] = str(record.seq)
-        references[lower_id + "_reverse"] = str(record.seq.reverse_complement())
-    return references
-
-if __name__ == '__main__':
-
-    args = parse_args()
-    references = load_reference_dict(args.references)
-    cpg_dict = load_cpg_dict(args.cpg_csv)
-    cpg_counter = make_cpg_counter(args.cpg_csv)
-    fw = open(str(args.report),"w")
-    fw2 = open(str(args.counts),"w")
-    nuc_matrix = parasail.Matrix(str(args.substitution_matrix))
-
-    counts, cpg_counts = process_file(str(args.reads), references, cpg_dict, args.sample, cpg_counter,nuc_matrix)
-
-    count_str = str(args.sample) + ","
-
-    cpg_order = args.cpg_header.split(",")
+def make_cpg_counter(cpg_csv):
+    return np.zeros((len(load_cpg_ids(cpg_csv)), N_COLUMNS), dtype=np.int64)
+
+def load_counts_csv(counts_files, cpg_ids, cpg_counter):
+    # raw counts add up across shards, "other" is whatever the total leaves over
+    for counts_file in counts_files:
+        with open(str(counts_file),"r") as f:
+            for row in csv.reader(f):
+                site_id = cpg_ids[row[1]]
+                total,c,t,a,g,gap = [int(i) for i in row[2:8]]
+                cpg_counter[site_id, BASE_COLUMNS["C"]] += c
+                cpg_counter[site_id, BASE_COLUMNS["T"]] += t
+                cpg_counter[site_id, BASE_COLUMNS["A"]] += a
+                cpg_counter[site_id, BASE_COLUMNS["G"]] += g
+                cpg_counter[site_id, BASE_COLUMNS["-"]] += gap
+                cpg_counter[site_id, OTHER_COLUMN] += total - (c + t + a + g + gap)
+    return cpg_counter
+
+def write_reports(sample, cpg_counts, cpg_ids, cpg_header, report=None, counts=None):
+    count_str = str(sample) + ","
+    count_lines = []
+
+    cpg_order = cpg_header.split(",")
     for i in cpg_order:
         if not i == "sample":
-            c_and_t = cpg_counts[i]["C"] + cpg_counts[i]["T"]
+            site_counts = cpg_counts[cpg_ids[i]]
+            c = int(site_counts[BASE_COLUMNS["C"]])
+            t = int(site_counts[BASE_COLUMNS["T"]])
+            a = int(site_counts[BASE_COLUMNS["A"]])
+            g = int(site_counts[BASE_COLUMNS["G"]])
+            gap = int(site_counts[BASE_COLUMNS["-"]])
+            total = int(site_counts.sum())
+
+            c_and_t = c + t
             prop = "NA"
-            if c_and_t > 50:
-                prop = round(cpg_counts[i]["C"] / c_and_t, 3)
+            if c_and_t > MIN_COVERAGE:
+                prop = round(c / c_and_t, 3)
             count_str += f"{prop},"
-            
-            
 
-            x = [j for j in cpg_counts[i]]
-            y = [cpg_counts[i][j] for j in cpg_counts[i]]
+            count_lines.append(f"{sample},{i},{total},{c},{t},{a},{g},{gap}\n")
 
-            print_string = i + '\t'
-            for index in range(len(x)):
-                print_string += f"{x[index]}\t{y[index]}\t"
+    count_str = count_str.rstrip(',')
+    if report:
+        with open(str(report),"w") as fw:
+            fw.write(count_str+'\n')
+    if counts:
+        with open(str(counts),"w") as fw2:
+            fw2.write("".join(count_lines))
 
-            total = sum(cpg_counts[i].values())
+def load_reference_dict(ref_file):
 
-            c = cpg_counts[i]["C"]
-            t = cpg_counts[i]["T"]
-            a = cpg_counts[i]["A"]
-            g= cpg_counts[i]["G"]
-            gap = cpg_counts[i]["-"]
-            fw2.write(f"{args.sample},{i},{total},{c},{t},{a},{g},{gap}\n")
+    references = {}
+    for record_id, seq in referencefunks.read_fasta(ref_file):
+        lower_id = record_id.lower()
+        references[lower_id+ "_forward"] = seq
+        references[lower_id + "_reverse"] = referencefunks.reverse_complement(seq)
+    return references
 
-    count_str = count_str.rstrip(',')
-    fw.write(count_str+'\n')
+def make_nuc_matrix(matrix_scores):
+    # parasail adds the '*' row and column for unknown letters itself, after the alphabet
+    alphabet = "".join(letter for letter in matrix_scores["alphabet"] if letter != "*")
+    nuc_matrix = parasail.matrix_create(alphabet, 0, 0)
+    for i, row in enumerate(matrix_scores["scores"]):
+        for j, score in enumerate(row):
+            nuc_matrix.set_value(i, j, score)
+    return nuc_matrix
+
+def make_reference_bundle(ref_file, cpg_csv, matrix_file, primer_csv=None):
+    """Parse everything the workers need from the species data files into
+    one json serialisable dict, the layout written by apollo build-reference."""
+    references = load_reference_dict(ref_file)
+    cpg_dict = load_cpg_dict(cpg_csv)
+    cpg_sites = [[gene] + list(site) for gene in cpg_dict for site in cpg_dict[gene]]
+    gene_lengths = [len(references[ref]) for ref in references if ref.endswith("_forward")]
+    min_length, max_length = referencefunks.get_read_length_window(gene_lengths)
+    return {
+        "version": referencefunks.BUNDLE_VERSION,
+        "sources": referencefunks.get_source_hashes({"references": ref_file, "cpg_sites": cpg_csv,
+                                                        "substitution_matrix": matrix_file, "primers": primer_csv}),
+        "references": references,
+        "cpg_sites": cpg_sites,
+        "cpg_header": ",".join(["sample"] + [site[1] for site in sorted(cpg_sites, key=lambda site: site[3])]),
+        "min_length": min_length,
+        "max_length": max_length,
+        "matrix": referencefunks.read_substitution_matrix(matrix_file),
+        "primer_anchors": load_primer_anchors(primer_csv, references)
+    }
+
+def get_reference_bundle(bundle_file, ref_file, cpg_csv, matrix_file, primer_csv=None):
+    # a bundle compiled from other versions of the data files is rebuilt in place
+    source_files = {"references": ref_file, "cpg_sites": cpg_csv, "substitution_matrix": matrix_file, "primers": primer_csv}
+    bundle = referencefunks.load_reference_bundle(bundle_file, source_files)
+    if bundle is None:
+        bundle = make_reference_bundle(ref_file, cpg_csv, matrix_file, primer_csv)
+        if bundle_file:
+            referencefunks.write_reference_bundle(bundle_file, bundle)
+    return bundle
+
+if __name__ == '__main__':
 
-    fw.close()
-    fw2.close()
\ No newline at end of file
+    args = parse_args()
+    cpg_ids = load_cpg_ids(args.cpg_csv)
+    cpg_counter = make_cpg_counter(args.cpg_csv)
+
+    if args.merge_counts:
+        cpg_counts = load_counts_csv(args.merge_counts, cpg_ids, cpg_counter)
+    else:
+        # reads are length filtered as they stream in, so barcode directories
+        # can be read directly without gathering them into one file first
+        if args.read_manifest:
+            fastq_files = fastqfunks.get_manifest_files(fastqfunks.load_read_manifest(args.read_manifest, [args.sample]), args.sample)
+        else:
+            fastq_files = fastqfunks.get_fastq_files(args.reads)
+        data_files = [args.references, args.cpg_csv, args.substitution_matrix] + ([args.primers] if args.primers else [])
+
+        # partial counts are reused for any file whose path, size and mtime are unchanged
+        # and that was counted with the same references, sites, matrix and settings
+        partial_results = {}
+        partial_files = {}
+        if args.partials_dir:
+            os.makedirs(args.partials_dir, exist_ok=True)
+            settings_fingerprint = get_settings_fingerprint(data_files, [args.min_length, args.max_length, args.kmer_size, args.candidates,
+                                                                            args.primer_search_length, COUNTS_VERSION])
+            for fastq_file in fastq_files:
+                partial_file = get_partial_file(args.partials_dir, fastq_file, settings_fingerprint, args.shard, args.shards)
+                partial_files[fastq_file] = partial_file
+                if os.path.exists(partial_file):
+                    partial_results[fastq_file] = load_partial(partial_file)
+        new_files = [fastq_file for fastq_file in fastq_files if fastq_file not in partial_results]
+
+        for fastq_file in partial_results:
+            cpg_counter += partial_results[fastq_file]["cpg_counts"]
+
+        # each shard only needs its share of the target, the merged counts reach it together.
+        # Interval widths shrink with the square root of the read count
+        coverage_reached = None
+        if args.target_coverage or args.target_ci_width:
+            site_ids = [cpg_ids[i] for i in args.cpg_header.split(",") if i != "sample"]
+            target_coverage = math.ceil(args.target_coverage / args.shards)
+            target_ci_width = args.target_ci_width * math.sqrt(args.shards)
+            coverage_reached = lambda new_counts: coverage_target_reached(cpg_counter + new_counts, site_ids, target_coverage, target_ci_width)
+
+        # cached site calls only depend on the data files and alignment settings, so they
+        # carry over between runs with different read filters, targets or reports
+        cache_file = None
+        cache_db = None
+        if args.cache_dir and new_files:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            cache_fingerprint = get_settings_fingerprint(data_files, [args.kmer_size, args.candidates, args.primer_search_length, COUNTS_VERSION])
+            cache_file = os.path.join(args.cache_dir, cache_fingerprint + ".sqlite")
+            cache_db = open_cache_db(cache_file)
+
+        bundle = get_reference_bundle(args.bundle, args.references, args.cpg_csv, args.substitution_matrix, args.primers)
+        cache_size = args.cache_size
+        if cache_size is None:
+            cache_size = CACHE_SIZE if args.cache_dir else 0
+        init_args = (bundle, args.kmer_size, args.candidates, bool(args.primers), args.primer_search_length,
+                        cache_size, cache_file)
+        file_settings = dict(chunk_size=args.chunk_size, min_length=args.min_length, max_length=args.max_length,
+                                shard=args.shard, shards=args.shards, threads=args.threads, coverage_reached=coverage_reached,
+                                cache_db=cache_db)
+        file_results = []
+        if new_files:
+            with worker_map(args.threads, init_args) as map_function:
+                file_results = process_fastq_files(new_files, len(cpg_ids), map_function, **file_settings)
+
+        # partial counts of a barcode that stopped early don't cover whole files, so they aren't kept
+        reads_skipped = sum(file_result["skipped"] for file_result in file_results)
+        length_counts = Counter()
+        cache_stats = Counter()
+        background = Counter()
+        reads_used = 0
+        for fastq_file, file_result in zip(new_files, file_results):
+            cache_stats.update(file_result["cache_stats"])
+            if args.partials_dir and not reads_skipped:
+                write_partial(partial_files[fastq_file], file_result)
+            cpg_counter += file_result["cpg_counts"]
+            partial_results[fastq_file] = file_result
+        for fastq_file in fastq_files:
+            length_counts.update(partial_results[fastq_file]["length_counts"])
+            background.update(partial_results[fastq_file]["background"])
+            reads_used += sum(partial_results[fastq_file]["counts"].values())
+        cpg_counts = cpg_counter
+
+        shard_str = f" (shard {args.shard + 1}/{args.shards})" if args.shards > 1 else ""
+        reused_str = f", reused partial counts for {len(fastq_files) - len(new_files)} of {len(fastq_files)} files" if args.partials_dir else ""
+        # every shard reads and length filters the whole barcode, but only counts its share of the reads
+        read_str = f"{reads_used + reads_skipped} of the barcode's {length_counts['passed']}" if args.shards > 1 else f"{length_counts['passed']}"
+        print(f"Barcode {args.sample}{shard_str}: {read_str} (rejected {length_counts['too_short']} too short, {length_counts['too_long']} too long{reused_str})")
+        if coverage_reached is not None and coverage_target_reached(cpg_counts, site_ids, target_coverage, target_ci_width):
+            print(f"Barcode {args.sample}{shard_str}: reached the coverage target using {reads_used} of {reads_used + reads_skipped} reads")
+        elif coverage_reached is not None:
+            print(f"Barcode {args.sample}{shard_str}: coverage target not reached, used all {reads_used} reads")
+        background_error_rate = get_background_error_rate(background)
+        if background_error_rate is not None:
+            print(f"Barcode {args.sample}{shard_str}: background error rate {100 * background_error_rate:.2f}% ({background['C']} C at {background['T']} aligned reference T positions)")
+        lookups = sum(cache_stats.values())
+        if lookups:
+            hits = cache_stats["memory"] + cache_stats["disk"]
+            print(f"Barcode {args.sample}{shard_str}: alignment cache hit {hits} of {lookups} reads ({100 * hits / lookups:.1f}%, {cache_stats['memory']} in memory, {cache_stats['disk']} on disk)")
+
+    write_reports(args.sample, cpg_counts, cpg_ids, args.cpg_header, args.report, args.counts)
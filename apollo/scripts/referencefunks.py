@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+
+# bumped whenever the layout of the bundle changes, so old bundles are rebuilt
+BUNDLE_VERSION = 1
+
+# IUPAC complements, the references carry Y for the converted C of every CpG
+COMPLEMENT = str.maketrans("ACGTUNRYKMSWBDHVacgtunrykmswbdhv", "TGCAANYRMKSWVHDBtgcaanyrmkswvhdb")
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def read_fasta(fasta_file):
+    """Yield (id, seq) for every record of a fasta file. The id is the first
+    word of the header line, as biopython reads it."""
+    record_id = None
+    seq_lines = []
+    with open(fasta_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if record_id is not None:
+                    yield record_id, "".join(seq_lines)
+                header = line[1:].split()
+                record_id = header[0] if header else ""
+                seq_lines = []
+            elif record_id is not None:
+                seq_lines.append(line)
+    if record_id is not None:
+        yield record_id, "".join(seq_lines)
+
+def read_substitution_matrix(matrix_file):
+    """Read a parasail/NCBI style substitution matrix into its alphabet and
+    rows of scores, in the order of the file."""
+    with open(matrix_file, "r") as f:
+        rows = [line.split() for line in f if line.strip() and not line.startswith("#")]
+    return {"alphabet": rows[0], "scores": [[int(score) for score in row[1:]] for row in rows[1:]]}
+
+def get_read_length_window(gene_lengths):
+    # reads shorter than the shortest amplicon can't cover it, and anything
+    # more than 200 bases longer than the longest is likely a chimera
+    return min(gene_lengths), max(gene_lengths) + 200
+
+def get_file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def get_source_hashes(source_files):
+    return {source: get_file_hash(source_files[source]) for source in source_files if source_files[source]}
+
+def load_reference_bundle(bundle_file, source_files):
+    """Return the bundle in bundle_file if it was compiled from the current
+    contents of every file in source_files, otherwise None."""
+    if not bundle_file or not os.path.exists(bundle_file):
+        return None
+    try:
+        with open(bundle_file, "r") as f:
+            bundle = json.load(f)
+    except ValueError:
+        return None
+    if bundle.get("version") != BUNDLE_VERSION:
+        return None
+    source_hashes = get_source_hashes(source_files)
+    for source in source_hashes:
+        if bundle["sources"].get(source) != source_hashes[source]:
+            return None
+    return bundle
+
+def write_reference_bundle(bundle_file, bundle):
+    # jobs running side by side may rebuild the same bundle, each writes its own
+    # temporary file and the last complete one to be moved into place wins
+    tmp_file = f"{bundle_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fw:
+        json.dump(bundle, fw)
+    os.replace(tmp_file, bundle_file)
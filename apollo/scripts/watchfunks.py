@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+import fastqfunks
+
+def snapshot_fastq_files(read_path):
+    snapshot = {}
+    for fastq_file in fastqfunks.find_fastq_files(read_path):
+        try:
+            stat = os.stat(fastq_file)
+        except FileNotFoundError:
+            continue
+        snapshot[fastq_file] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+def get_settled_snapshot(read_path, settle=1):
+    # files that are still being written change size between two looks
+    snapshot = snapshot_fastq_files(read_path)
+    while True:
+        time.sleep(settle)
+        next_snapshot = snapshot_fastq_files(read_path)
+        if next_snapshot == snapshot:
+            return snapshot
+        snapshot = next_snapshot
+
+def run_finished(read_path):
+    # MinKNOW writes final_summary_*.txt into the run directory, next to
+    # fastq_pass, once sequencing has stopped
+    for path in [read_path, os.path.dirname(os.path.abspath(read_path))]:
+        for fn in os.listdir(path):
+            if fn.startswith("final_summary") and fn.endswith(".txt"):
+                return True
+    return False
+
+def make_waiter(read_path):
+    """Return a function that blocks for up to timeout seconds, returning
+    early when files land under read_path if inotify_simple is installed,
+    and otherwise just sleeping so the directory is polled."""
+    try:
+        import inotify_simple
+    except ImportError:
+        return time.sleep
+
+    inotify = inotify_simple.INotify()
+    watch_flags = inotify_simple.flags.CREATE | inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+    watched = set()
+
+    def add_watches():
+        # barcode directories appear during the run, so new ones are picked up each time
+        for r,d,f in os.walk(read_path):
+            if r not in watched:
+                inotify.add_watch(r, watch_flags)
+                watched.add(r)
+
+    def wait(timeout):
+        add_watches()
+        inotify.read(timeout=int(timeout * 1000))
+
+    return wait
+
+def follow_reads(read_path, interval=10, idle_timeout=0, settle=1):
+    """Yield a snapshot of the fastq files under read_path each time new or
+    changed files have finished landing. Stops once the sequencing run has
+    finished, or after idle_timeout seconds without new reads if given."""
+    wait = make_waiter(read_path)
+    counted = {}
+    last_change = time.monotonic()
+    while True:
+        # checked first so that reads written before the final summary are still counted
+        finished = run_finished(read_path)
+        snapshot = get_settled_snapshot(read_path, settle)
+        if snapshot and snapshot != counted:
+            counted = snapshot
+            last_change = time.monotonic()
+            yield snapshot
+        elif finished:
+            return
+        elif idle_timeout and time.monotonic() - last_change > idle_timeout:
+            return
+        else:
+            wait(interval)
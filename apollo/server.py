@@ -0,0 +1,258 @@
+# apollo serve: a long running process that keeps the references of each species
+# and a pool of workers ready, and counts the jobs posted to it over http. Every
+# job is one read path of barcode directories, so small reruns skip starting
+# python, snakemake and the workers and compiling the references each time
+import os
+import sys
+import json
+import time
+import queue
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from apollo import __version__
+from apollo import methylation
+import apollofunks
+import clockfunks
+import fastqfunks
+
+HOST = "127.0.0.1"
+
+class Job():
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.request = request
+        self.state = "queued"
+        self.error = None
+        self.results = {}
+        self.events = []
+        self.condition = threading.Condition()
+        self.add_event("queued")
+
+    def add_event(self, event, **details):
+        with self.condition:
+            self.events.append(dict(event=event, time=round(time.time(), 3), **details))
+            self.condition.notify_all()
+
+    def finish(self, state, error=None):
+        with self.condition:
+            self.state = state
+            self.error = error
+        self.add_event(state, **({"error": error} if error else {"results": self.results}))
+
+    def stream(self):
+        # yields every event so far, then each new one as it happens until the job is done
+        sent = 0
+        while True:
+            with self.condition:
+                while sent == len(self.events) and self.state not in ["finished", "failed"]:
+                    self.condition.wait()
+                events = self.events[sent:]
+                done = self.state in ["finished", "failed"]
+            sent += len(events)
+            yield from events
+            if done and sent == len(self.events):
+                return
+
+    def to_dict(self):
+        with self.condition:
+            return {"job": self.id, "state": self.state, "error": self.error, "request": self.request,
+                    "events": list(self.events), "results": self.results}
+
+class ApolloServer():
+    """Counts the jobs posted to the server one at a time, on the worker pool
+    of their species. The pools are all started before serving, as forking
+    them once the http threads are running isn't safe."""
+
+    def __init__(self, species, threads):
+        self.counters = {}
+        for name in species:
+            print(apollofunks.green(f"Loading {name}:") + f" references and {threads} workers")
+            self.counters[name] = methylation.MethylationCounter(name, threads)
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.job_queue = queue.Queue()
+        self.runner = threading.Thread(target=self.run_jobs, daemon=True)
+        self.runner.start()
+
+    def submit(self, request):
+        if not isinstance(request, dict) or not request.get("read_path"):
+            raise ValueError("a job needs a `read_path`")
+        species = request.get("species", apollofunks.DEFAULT_SPECIES)
+        if species not in self.counters:
+            raise ValueError(f"{species} is not loaded, the server has: {', '.join(self.counters)}")
+        if not os.path.isdir(request["read_path"]):
+            raise ValueError(f"cannot find reads at {request['read_path']}")
+        request = dict(request, species=species)
+        if request.get("report"):
+            request["clock_model"] = request.get("clock_model") or apollofunks.get_package_file(f"data/{species}/clock_model.csv")
+            if not os.path.exists(request["clock_model"]):
+                raise ValueError(f"no clock model for {species} at {request['clock_model']}, give one as `clock_model`")
+            if not request.get("outdir"):
+                raise ValueError("a job with `report` needs an `outdir`")
+        job = Job(next(self.job_ids), request)
+        self.jobs[job.id] = job
+        self.job_queue.put(job)
+        return job
+
+    def run_jobs(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            job.state = "running"
+            job.add_event("started")
+            try:
+                self.run_job(job)
+                job.finish("finished")
+            except Exception as error:
+                job.finish("failed", str(error))
+
+    def run_job(self, job):
+        request = job.request
+        counter = self.counters[request["species"]]
+        manifest = fastqfunks.make_read_manifest(request["read_path"])
+        barcodes = request.get("barcodes") or list(manifest)
+        missing = [barcode for barcode in barcodes if barcode not in manifest]
+        if missing:
+            raise ValueError(f"no barcode directories {', '.join(missing)} in {request['read_path']}")
+
+        outdir = request.get("outdir")
+        if outdir:
+            os.makedirs(os.path.join(outdir, "counts"), exist_ok=True)
+            os.makedirs(os.path.join(outdir, "reports"), exist_ok=True)
+
+        for barcode in barcodes:
+            fastq_files = fastqfunks.get_manifest_files(manifest, barcode)
+            job.add_event("barcode_started", barcode=barcode, fastq_files=len(fastq_files))
+            read_seqs = itertools.chain.from_iterable(fastqfunks.read_fastq_seqs(fastq_file) for fastq_file in fastq_files)
+            result, = counter.count([read_seqs], min_length=request.get("min_length"), max_length=request.get("max_length"))
+
+            job.results[barcode] = {
+                "reads": result.length_counts["passed"],
+                "too_short": result.length_counts["too_short"],
+                "too_long": result.length_counts["too_long"],
+                "references": dict(result.reference_counts),
+                "background_error_rate": result.background_error_rate,
+                "methylation": result.methylation
+            }
+            if outdir:
+                result.write_reports(barcode, report=os.path.join(outdir, "counts", f"{barcode}.cpg_wide.csv"),
+                                        counts=os.path.join(outdir, "counts", f"{barcode}.cpg_counts.csv"))
+            job.add_event("barcode_finished", barcode=barcode, reads=result.length_counts["passed"])
+
+        if outdir:
+            write_job_reports(outdir, barcodes, counter.sites)
+            if request.get("report"):
+                self.predict_ages(job, outdir)
+
+    def predict_ages(self, job, outdir):
+        model = clockfunks.load_clock_model(job.request["clock_model"])
+        samples, cpg_methylation, runs = clockfunks.read_cpg_wide(os.path.join(outdir, "reports", "cpg_wide.csv"), model["sites"])
+        ages, imputed = clockfunks.predict_ages(model, cpg_methylation)
+        clockfunks.write_age_table(os.path.join(outdir, "reports", "predicted_age.csv"), samples, ages, imputed)
+        for sample, age, n_imputed in zip(samples, ages, imputed):
+            job.results[sample]["predicted_age"] = None if age != age else round(float(age), 2)
+            job.results[sample]["sites_imputed"] = int(n_imputed)
+
+    def close(self):
+        self.job_queue.put(None)
+        for counter in self.counters.values():
+            counter.close()
+
+def write_job_reports(outdir, barcodes, sites):
+    # the same reports/cpg_wide.csv and reports/cpg_counts.csv as the pipeline writes
+    with open(os.path.join(outdir, "reports", "cpg_wide.csv"), "w") as fw:
+        fw.write(",".join(["sample"] + sites) + "\n")
+        for barcode in barcodes:
+            with open(os.path.join(outdir, "counts", f"{barcode}.cpg_wide.csv"), "r") as f:
+                fw.write(f.read())
+    with open(os.path.join(outdir, "reports", "cpg_counts.csv"), "w") as fw:
+        fw.write("sample,cpg_site,total,c,t,a,g,-\n")
+        for barcode in barcodes:
+            with open(os.path.join(outdir, "counts", f"{barcode}.cpg_counts.csv"), "r") as f:
+                fw.write(f.read())
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """GET /status, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/events (newline
+    delimited json, streamed until the job is done), POST /jobs and POST /shutdown."""
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, job_id):
+        try:
+            return self.server.apollo.jobs[int(job_id)]
+        except (ValueError, KeyError):
+            self.send_json({"error": f"no job {job_id}"}, 404)
+            return None
+
+    def do_GET(self):
+        path = self.path.strip("/").split("/")
+        apollo = self.server.apollo
+        if path in [[""], ["status"]]:
+            states = [job.state for job in list(apollo.jobs.values())]
+            self.send_json({"version": __version__, "species": list(apollo.counters),
+                            "jobs": {state: states.count(state) for state in set(states)}})
+        elif path == ["jobs"]:
+            self.send_json([{"job": job.id, "state": job.state} for job in list(apollo.jobs.values())])
+        elif len(path) == 2 and path[0] == "jobs":
+            job = self.get_job(path[1])
+            if job:
+                self.send_json(job.to_dict())
+        elif len(path) == 3 and path[0] == "jobs" and path[2] == "events":
+            job = self.get_job(path[1])
+            if job:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for event in job.stream():
+                    self.wfile.write((json.dumps(event) + "\n").encode())
+                    self.wfile.flush()
+        else:
+            self.send_json({"error": f"no such endpoint {self.path}"}, 404)
+
+    def do_POST(self):
+        path = self.path.strip("/").split("/")
+        if path == ["jobs"]:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = self.server.apollo.submit(json.loads(self.rfile.read(length) or b"{}"))
+            except ValueError as error:
+                self.send_json({"error": str(error)}, 400)
+                return
+            self.send_json({"job": job.id, "state": job.state}, 202)
+        elif path == ["shutdown"]:
+            self.send_json({"state": "shutting down"})
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            self.send_json({"error": f"no such endpoint {self.path}"}, 404)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def serve(port, species, threads, verbose=False):
+    # jobs write wherever the client asks and nothing is authenticated,
+    # so the server only ever listens on the loopback address
+    apollo = ApolloServer(species, threads)
+    httpd = ThreadingHTTPServer((HOST, port), RequestHandler)
+    httpd.daemon_threads = True
+    httpd.apollo = apollo
+    httpd.verbose = verbose
+    print(apollofunks.green("apollo serving on:") + f" http://{HOST}:{httpd.server_address[1]}")
+    sys.stdout.flush()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        apollo.close()
+    return 0
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Time get_best_reference + align_read over a matrix of species, read
+lengths and number of candidate references, in microseconds per read.
+
+Longer reads are the simulated amplicon reads with random sequence added,
+as reads with adapters and untrimmed ends are. Each version of the scripts
+is timed in its own process, taking turns for every repeat so that load on
+the machine affects them alike, and an older checkout can be compared with
+this one side by side:
+
+    git worktree add ../apollo_before <commit>
+    python benchmarks/alignment_kernels.py --scripts ../apollo_before/apollo/scripts apollo/scripts
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time reference scoring and alignment per read length and candidates')
+    parser.add_argument("--scripts", action="store", nargs="+", type=str, dest="scripts",
+                        default=[os.path.join(thisdir, "..", "apollo", "scripts")],
+                        help="apollo/scripts directories to time. Default: this checkout's")
+    parser.add_argument("-s", "--species", action="store", nargs="+", type=str, dest="species", default=["mus", "apodemus", "desmodus"])
+    parser.add_argument("-n", "--reads", action="store", type=int, dest="reads", default=300)
+    parser.add_argument("--extra-lengths", action="store", nargs="+", type=int, dest="extra_lengths", default=[0, 200],
+                        help="Random bases added to the reads of each row")
+    parser.add_argument("--repeats", action="store", type=int, dest="repeats", default=5)
+    parser.add_argument("--worker", action="store", type=str, dest="worker", help=argparse.SUPPRESS)
+    parser.add_argument("--reads-dir", action="store", type=str, dest="reads_dir", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def write_reads(reads_file, species, n_reads, extra_lengths):
+    import simulate_reads
+    rng = random.Random(3)
+    reads = simulate_reads.simulate_reads(simulate_reads.get_data_file(species, "genes.fasta"), n_reads, seed=5)
+    rows = {extra_length: [read + simulate_reads.random_seq(rng, extra_length) for read in reads] for extra_length in extra_lengths}
+    with open(reads_file, "w") as fw:
+        json.dump(rows, fw)
+
+def time_kernels(scripts_dir, reads_dir, species_list, repeats):
+    """Run in a worker process, with the paramether of scripts_dir."""
+    sys.path.insert(0, scripts_dir)
+    import paramether
+    import referencefunks
+
+    data_dir = os.path.join(thisdir, "..", "apollo", "data")
+    matrix = paramether.make_nuc_matrix(referencefunks.read_substitution_matrix(os.path.join(data_dir, "substitution_matrix.txt")))
+    timings = []
+    for species in species_list:
+        references = paramether.load_reference_dict(os.path.join(data_dir, species, "genes.fasta"))
+        with open(os.path.join(reads_dir, f"{species}.json"), "r") as f:
+            rows = json.load(f)
+        for extra_length, reads in rows.items():
+            for n_candidates in sorted(set([1, 2, len(references)])):
+                candidates = list(references)[:n_candidates]
+                best = None
+                for i in range(repeats):
+                    start = time.perf_counter()
+                    for read in reads:
+                        paramether.get_best_reference(read, references, matrix, candidates=candidates)
+                        paramether.align_read(read, candidates[0], references[candidates[0]], matrix)
+                    seconds = time.perf_counter() - start
+                    best = seconds if best is None else min(best, seconds)
+                timings.append([species, round(sum(map(len, reads)) / len(reads)), n_candidates, best / len(reads) * 1e6])
+    return timings
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    if args.worker:
+        json.dump(time_kernels(args.worker, args.reads_dir, args.species, args.repeats), sys.stdout)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for species in args.species:
+            write_reads(os.path.join(tempdir, f"{species}.json"), species, args.reads, args.extra_lengths)
+
+        # each worker takes the best of two passes, the first of which warms it up
+        columns = [None] * len(args.scripts)
+        for repeat in range(args.repeats):
+            for i, scripts_dir in enumerate(args.scripts):
+                process = subprocess.run([sys.executable, __file__, "--worker", os.path.abspath(scripts_dir), "--reads-dir", tempdir,
+                                            "--repeats", "2", "-s"] + args.species,
+                                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+                timings = json.loads(process.stdout)
+                if columns[i] is not None:
+                    timings = [row[:3] + [min(row[3], best_row[3])] for row, best_row in zip(timings, columns[i])]
+                columns[i] = timings
+
+    print(f"get_best_reference + align_read, us per read (min of {args.repeats}, {args.reads} simulated reads per row)")
+    for i, scripts_dir in enumerate(args.scripts):
+        print(f"  [{i + 1}] {scripts_dir}")
+    print(f"  {'species':10s} {'read len':>8s} {'candidates':>10s}" + "".join(f" {f'[{i + 1}]':>7s}" for i in range(len(args.scripts))))
+    for rows in zip(*columns):
+        species, read_length, n_candidates = rows[0][:3]
+        print(f"  {species:10s} {read_length:8d} {n_candidates:10d}" + "".join(f" {row[3]:7.0f}" for row in rows))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Measure how well and how fast demuxer.py assigns simulated barcoded reads.
+
+Native reads are an amplicon with the native adapter and barcode flanks
+ligated to both ends (the far one reverse complemented), and are classified
+against the native kit. Rapid reads only carry the rapid barcode and flanks
+at their start, and are classified against all kits, as with
+`--barcode-kit all`. Errors are added at the given rates and half of the reads
+reverse complemented. A fraction of reads carry no barcode, so false
+positives can be counted. Reads are classified in-process, with the barcode
+k-mer ranking and against every barcode:
+
+    python benchmarks/demultiplex_accuracy.py -n 5000 --error-rates 0.06 0.1
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(thisdir, "..", "apollo", "scripts"))
+import simulate_reads
+import demuxer
+import referencefunks
+
+ADAPTER = "AATGTACTTCGTTCAGTTACGTATTGCT"
+BARCODE_FLANKS = {
+    "native": ("AAGGTTAA", "CAGCACCT"),
+    "rapid": ("GCTTGGGTGTTTAACC", "GTTTTCGCATTTATCGTGAAACGCTTTCGCGTTTTTCGTGCGCCGCTTCA")
+}
+# the kit each kit's reads are classified against
+CLASSIFY_KITS = {"native": "native", "rapid": "all"}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time and score demultiplexing of simulated barcoded reads')
+    parser.add_argument("-s", "--species", action="store", type=str, dest="species", default="mus")
+    parser.add_argument("-n", "--reads", action="store", type=int, dest="reads", default=5000)
+    parser.add_argument("--barcodes", action="store", type=int, dest="barcodes", default=12,
+                        help="Number of barcodes reads are drawn from")
+    parser.add_argument("--no-barcode", action="store", type=float, dest="no_barcode", default=0.05,
+                        help="Fraction of reads without a barcode")
+    parser.add_argument("--error-rates", action="store", nargs="+", type=float, dest="error_rates", default=[0.06, 0.1])
+    parser.add_argument("--seed", action="store", type=int, dest="seed", default=7)
+    return parser.parse_args()
+
+def simulate_barcoded_reads(genes_fasta, barcodes, kit, n_reads, error_rate, no_barcode=0.05, seed=7):
+    """(true barcode or "unclassified", read) for n_reads simulated reads of
+    a native or rapid kit, barcodes giving the kit's sequence of each barcode."""
+    rng = random.Random(seed)
+    genes = [seq.upper() for record_id, seq in referencefunks.read_fasta(genes_fasta)]
+    flanks = BARCODE_FLANKS[kit]
+    reads = []
+    for i in range(n_reads):
+        amplicon = "".join(rng.choice("CT") if base == "Y" else base for base in rng.choice(genes))
+        leader = simulate_reads.random_seq(rng, rng.randint(5, 40)) + ADAPTER + flanks[0]
+        if rng.random() < no_barcode:
+            barcode = "unclassified"
+            end = leader + simulate_reads.random_seq(rng, 24) + flanks[1]
+        else:
+            barcode = rng.choice(sorted(barcodes))
+            end = leader + barcodes[barcode] + flanks[1]
+        if kit == "native":
+            read = end + amplicon + referencefunks.reverse_complement(end)
+        else:
+            read = end + amplicon + simulate_reads.random_seq(rng, rng.randint(5, 40))
+        if rng.random() < 0.5:
+            read = referencefunks.reverse_complement(read)
+        reads.append((barcode, simulate_reads.add_errors(read, error_rate, rng)))
+    return reads
+
+def classify_reads(reads, barcodes, kmer_size):
+    settings = {"max_errors": 4, "min_margin": 3, "kmer_size": kmer_size, "candidates": 3, "search_length": 150}
+    demuxer.init_worker(barcodes, settings)
+    start = time.perf_counter()
+    assigned = [demuxer.classify_read(read, demuxer.worker_data["barcode_profiles"], settings["max_errors"], settings["min_margin"],
+                                        demuxer.worker_data["kmer_index"], kmer_size, settings["candidates"], settings["search_length"])
+                    for barcode, read in reads]
+    return assigned, time.perf_counter() - start
+
+def score(reads, assigned):
+    scores = collections.Counter()
+    for (barcode, read), call in zip(reads, assigned):
+        if barcode == "unclassified":
+            scores["false_positive"] += call != "unclassified"
+        else:
+            scores["barcoded"] += 1
+            scores["correct"] += call == barcode
+            scores["unclassified"] += call == "unclassified"
+            scores["wrong"] += call not in [barcode, "unclassified"]
+    return scores
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    barcodes_file = os.path.join(simulate_reads.data_dir, "barcodes.csv")
+    print(f"{args.reads} simulated {args.species} reads per kit, {args.barcodes} barcodes, {args.no_barcode:.0%} without a barcode, 1 core")
+    for read_kit, classify_kit in CLASSIFY_KITS.items():
+        # the reads only carry some of the barcodes, but are classified against the whole kit
+        kit_barcodes = demuxer.load_barcodes(barcodes_file, read_kit)
+        barcodes = {barcode: kit_barcodes[barcode][0] for barcode in sorted(kit_barcodes)[:args.barcodes]}
+        kit = demuxer.load_barcodes(barcodes_file, classify_kit)
+        for error_rate in args.error_rates:
+            reads = simulate_barcoded_reads(simulate_reads.get_data_file(args.species, "genes.fasta"), barcodes, read_kit,
+                                            args.reads, error_rate, args.no_barcode, args.seed)
+            for name, kmer_size in [("k-mer ranked", 5), ("all barcodes", 0)]:
+                assigned, seconds = classify_reads(reads, kit, kmer_size)
+                scores = score(reads, assigned)
+                print(f"  {read_kit} reads as {classify_kit}, {error_rate:.0%} error, {name}: "
+                        f"{scores['correct'] / scores['barcoded']:.2%} correct, "
+                        f"{scores['unclassified'] / scores['barcoded']:.2%} unclassified, {scores['wrong']} wrong barcode, "
+                        f"{scores['false_positive']} false positives, {seconds:.1f} s")
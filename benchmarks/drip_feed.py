@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Drip-feed the fastq files of a read directory into another one, the way
+MinKNOW writes them during a run, to try out `apollo --follow`.
+
+Each fastq file of the barcode directories in the source is written to the
+same barcode directory in the destination, one every --delay seconds. A
+file is written in --pieces writes over --write-time seconds, so apollo also
+sees files that are still growing, then the directory is left alone until
+the next one. When every file has landed, final_summary_drip_feed.txt is
+written, which ends following. In two terminals:
+
+    python benchmarks/drip_feed.py reads/ live_reads/ --delay 5
+    apollo -i live_reads/ --follow -s mus --outdir live_run
+"""
+import argparse
+import os
+import sys
+import time
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(thisdir, "..", "apollo", "scripts"))
+import fastqfunks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Copy fastq files into a read directory one at a time')
+    parser.add_argument("source", help="Read directory with barcode directories of fastq files")
+    parser.add_argument("destination", help="Read directory to write them to")
+    parser.add_argument("--delay", action="store", type=float, dest="delay", default=5,
+                        help="Seconds between files. Default: 5")
+    parser.add_argument("--pieces", action="store", type=int, dest="pieces", default=4,
+                        help="Number of writes each file is spread over. Default: 4")
+    parser.add_argument("--write-time", action="store", type=float, dest="write_time", default=1,
+                        help="Seconds the writes of each file are spread over. Default: 1")
+    parser.add_argument("--no-summary", action="store_true", dest="no_summary",
+                        help="Don't write a final_summary file at the end, so apollo keeps following")
+    return parser.parse_args()
+
+def drip_file(source_file, destination_file, pieces, write_time):
+    with open(source_file, "rb") as f:
+        data = f.read()
+    piece_size = len(data) // pieces + 1
+    with open(destination_file, "wb") as fw:
+        for start in range(0, len(data), piece_size):
+            fw.write(data[start:start + piece_size])
+            fw.flush()
+            time.sleep(write_time / pieces)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    fastq_files = sorted(fastqfunks.find_fastq_files(args.source))
+    if not fastq_files:
+        sys.stderr.write(f"Error: no fastq files in {args.source}\n")
+        sys.exit(-1)
+
+    os.makedirs(args.destination, exist_ok=True)
+    for i, source_file in enumerate(fastq_files):
+        destination_file = os.path.join(args.destination, os.path.relpath(source_file, args.source))
+        os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+        drip_file(source_file, destination_file, args.pieces, args.write_time)
+        print(f"[{i + 1}/{len(fastq_files)}] {destination_file}", flush=True)
+        time.sleep(max(args.delay - args.write_time, 0))
+
+    if not args.no_summary:
+        with open(os.path.join(args.destination, "final_summary_drip_feed.txt"), "w") as fw:
+            fw.write(f"files={len(fastq_files)}\n")
+        print("Wrote final_summary_drip_feed.txt")
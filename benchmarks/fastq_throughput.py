@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Compare fastqfunks' reader and length filter with biopython's SeqIO.
+
+Writes a synthetic fastq of random reads (lengths spread around the read
+length window, so some are filtered out) and times parsing it and length
+filtering it into a new fastq, the way gather_demuxed_reads does:
+
+    python benchmarks/fastq_throughput.py --reads 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(thisdir, "..", "apollo", "scripts"))
+import fastqfunks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time fastq parsing and length filtering against SeqIO')
+    parser.add_argument("--reads", action="store", type=int, dest="reads", default=200000)
+    parser.add_argument("--min-length", action="store", type=int, dest="min_length", default=200)
+    parser.add_argument("--max-length", action="store", type=int, dest="max_length", default=450)
+    parser.add_argument("--repeats", action="store", type=int, dest="repeats", default=3)
+    parser.add_argument("--seed", action="store", type=int, dest="seed", default=1)
+    parser.add_argument("--tempdir", action="store", type=str, dest="tempdir",
+                        help="Where to write the synthetic fastq. Default: $TMPDIR")
+    return parser.parse_args()
+
+def write_synthetic_fastq(fastq_file, n_reads, min_length, max_length, seed=1):
+    rng = random.Random(seed)
+    with open(fastq_file, "w") as fw:
+        for i in range(n_reads):
+            length = rng.randint(min_length // 2, max_length + min_length // 2)
+            seq = "".join(rng.choices("ACGT", k=length))
+            qual = "".join(rng.choices("#+5?I", k=length))
+            fw.write(f"@read{i} runid=synthetic read={i} ch=1\n{seq}\n+\n{qual}\n")
+
+def time_function(function, repeats):
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def parse_seqio(fastq_file):
+    from Bio import SeqIO
+    for record in SeqIO.parse(fastq_file, "fastq"):
+        str(record.seq)
+
+def parse_read_fastq(fastq_file):
+    for name, seq, qual in fastqfunks.read_fastq(fastq_file):
+        pass
+
+def parse_read_fastq_seqs(fastq_file):
+    for seq in fastqfunks.read_fastq_seqs(fastq_file):
+        pass
+
+def filter_seqio(fastq_file, output_file, min_length, max_length):
+    from Bio import SeqIO
+    with open(output_file, "w") as fw:
+        records = (record for record in SeqIO.parse(fastq_file, "fastq") if min_length < len(record) < max_length)
+        SeqIO.write(records, fw, "fastq")
+
+def filter_fast_path(fastq_file, output_file, min_length, max_length):
+    with open(output_file, "w") as fw:
+        fastqfunks.write_length_filtered_reads([fastq_file], fw, min_length, max_length)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    try:
+        import Bio
+        has_biopython = True
+    except ImportError:
+        sys.stderr.write("biopython is not installed, only timing fastqfunks\n")
+        has_biopython = False
+
+    with tempfile.TemporaryDirectory(dir=args.tempdir) as tempdir:
+        fastq_file = os.path.join(tempdir, "synthetic.fastq")
+        write_synthetic_fastq(fastq_file, args.reads, args.min_length, args.max_length, args.seed)
+        size_mb = os.path.getsize(fastq_file) / 1e6
+        print(f"{args.reads} synthetic reads ({size_mb:.0f} MB), min of {args.repeats} runs")
+
+        timings = []
+        if has_biopython:
+            timings.append(("parse, SeqIO.parse", lambda: parse_seqio(fastq_file)))
+        timings.append(("parse, read_fastq", lambda: parse_read_fastq(fastq_file)))
+        timings.append(("parse, read_fastq_seqs", lambda: parse_read_fastq_seqs(fastq_file)))
+        outputs = {}
+        if has_biopython:
+            outputs["SeqIO"] = os.path.join(tempdir, "seqio.fastq")
+            timings.append(("length filter + write, SeqIO", lambda: filter_seqio(fastq_file, outputs["SeqIO"], args.min_length, args.max_length)))
+        outputs["fast path"] = os.path.join(tempdir, "fast_path.fastq")
+        timings.append(("length filter + write, filter_fastq_by_length", lambda: filter_fast_path(fastq_file, outputs["fast path"], args.min_length, args.max_length)))
+
+        for name, function in timings:
+            seconds = time_function(function, args.repeats)
+            print(f"  {name:46s} {seconds:6.2f} s  ({args.reads / seconds / 1000:.0f}k reads/s)")
+
+        if has_biopython:
+            with open(outputs["SeqIO"], "r") as seqio_output, open(outputs["fast path"], "r") as fast_output:
+                identical = seqio_output.read() == fast_output.read()
+            print(f"Filtered fastq identical to SeqIO.write: {'yes' if identical else 'NO'}")
+            if not identical:
+                sys.exit(1)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Time paramether.py end to end on simulated reads, on one core.
+
+Counts the same simulated reads with each paramether.py given (by default
+the one in this checkout), reporting the wall time, including python
+startup, and reads per second. To compare with an older version, check it
+out next to this one and give both scripts:
+
+    git worktree add ../apollo_before <commit>
+    python benchmarks/reads_per_second.py --paramether ../apollo_before/apollo/scripts/paramether.py apollo/scripts/paramether.py
+
+Only the options every version has are passed, so each runs with its own
+defaults. The cpg_wide.csv of every script after the first is checked
+against the first one's.
+"""
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+import simulate_reads
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time paramether.py end to end on simulated reads')
+    parser.add_argument("--paramether", action="store", nargs="+", type=str, dest="paramether",
+                        default=[os.path.join(thisdir, "..", "apollo", "scripts", "paramether.py")])
+    parser.add_argument("-s", "--species", action="store", type=str, dest="species", default="mus")
+    parser.add_argument("-n", "--reads", action="store", type=int, dest="reads", default=2000)
+    parser.add_argument("--repeats", action="store", type=int, dest="repeats", default=3)
+    return parser.parse_args()
+
+def get_cpg_header(cpg_csv):
+    with open(cpg_csv, "r") as f:
+        return ",".join(["sample"] + [row["gene"].lower() + "_" + row["position"] for row in csv.DictReader(f)])
+
+def run_paramether(paramether, reads, species, report, counts):
+    cpg_csv = simulate_reads.get_data_file(species, "cpg_sites.csv")
+    command = [sys.executable, paramether, "--reads", reads,
+                "--references", simulate_reads.get_data_file(species, "genes.fasta"),
+                "--cpg_csv", cpg_csv, "--cpg-header", get_cpg_header(cpg_csv),
+                "--substitution_matrix", os.path.join(simulate_reads.data_dir, "substitution_matrix.txt"),
+                "--sample", "simulated", "--report", report, "--counts", counts]
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        reads = os.path.join(tempdir, "simulated.fastq")
+        simulate_reads.write_fastq(reads, simulate_reads.simulate_reads(simulate_reads.get_data_file(args.species, "genes.fasta"), args.reads))
+        print(f"{args.reads} simulated {args.species} reads, 1 core, min of {args.repeats} runs including python startup")
+
+        reports = []
+        for i, paramether in enumerate(args.paramether):
+            report = os.path.join(tempdir, f"cpg_wide_{i}.csv")
+            counts = os.path.join(tempdir, f"cpg_counts_{i}.csv")
+            seconds = min(run_paramether(paramether, reads, args.species, report, counts) for repeat in range(args.repeats))
+            with open(report, "r") as f:
+                reports.append(f.read())
+            same = "" if i == 0 else ("  (cpg_wide.csv identical)" if reports[i] == reports[0] else "  (cpg_wide.csv differs)")
+            print(f"  {paramether}: {seconds:.2f} s, {args.reads / seconds:.0f} reads/s{same}")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Simulated nanopore reads for the benchmarks.
+
+Amplicon reads are drawn from a species' genes.fasta, with every ambiguous
+CpG base (Y) read as C or T at random, substitution, deletion and insertion
+errors at error_rate, random flanks and half of them reverse complemented.
+A fraction of junk reads, random sequence of amplicon length, can be mixed in:
+
+    python benchmarks/simulate_reads.py -s mus -n 2000 -o mus_2k.fastq
+"""
+import argparse
+import os
+import random
+import sys
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+data_dir = os.path.join(thisdir, "..", "apollo", "data")
+sys.path.insert(0, os.path.join(thisdir, "..", "apollo", "scripts"))
+import referencefunks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Write simulated amplicon reads of a species to a fastq file')
+    parser.add_argument("-s", "--species", action="store", type=str, dest="species", default="mus")
+    parser.add_argument("-n", "--reads", action="store", type=int, dest="reads", default=2000)
+    parser.add_argument("-e", "--error-rate", action="store", type=float, dest="error_rate", default=0.04)
+    parser.add_argument("--junk", action="store", type=float, dest="junk", default=0,
+                        help="Fraction of reads that are random sequence")
+    parser.add_argument("--seed", action="store", type=int, dest="seed", default=1)
+    parser.add_argument("-o", "--output", action="store", type=str, dest="output", required=True)
+    return parser.parse_args()
+
+def get_data_file(species, name):
+    return os.path.join(data_dir, species, name)
+
+def random_seq(rng, length):
+    return "".join(rng.choice("ACGT") for i in range(length))
+
+def add_errors(seq, error_rate, rng):
+    read = []
+    for base in seq:
+        r = rng.random()
+        if r < error_rate / 3:
+            read.append(rng.choice("ACGT"))
+        elif r < 2 * error_rate / 3:
+            continue
+        elif r < error_rate:
+            read.append(base)
+            read.append(rng.choice("ACGT"))
+        else:
+            read.append(base)
+    return "".join(read)
+
+def simulate_reads(genes_fasta, n_reads, error_rate=0.04, junk=0, seed=1):
+    rng = random.Random(seed)
+    genes = [seq.upper() for record_id, seq in referencefunks.read_fasta(genes_fasta)]
+    reads = []
+    for i in range(n_reads):
+        gene = rng.choice(genes)
+        if rng.random() < junk:
+            reads.append(random_seq(rng, len(gene)))
+            continue
+        amplicon = "".join(rng.choice("CT") if base == "Y" else base for base in gene)
+        read = random_seq(rng, rng.randint(5, 30)) + add_errors(amplicon, error_rate, rng) + random_seq(rng, rng.randint(5, 30))
+        if rng.random() < 0.5:
+            read = referencefunks.reverse_complement(read)
+        reads.append(read)
+    return reads
+
+def write_fastq(fastq_file, seqs):
+    with open(fastq_file, "w") as fw:
+        for i, seq in enumerate(seqs):
+            fw.write(f"@read{i} runid=simulated\n{seq}\n+\n{'5' * len(seq)}\n")
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    reads = simulate_reads(get_data_file(args.species, "genes.fasta"), args.reads, args.error_rate, args.junk, args.seed)
+    write_fastq(args.output, reads)
+    print(f"{len(reads)} simulated {args.species} reads -> {args.output}")
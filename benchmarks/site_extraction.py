@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Compare reading the CpG sites of a read from one CIGAR decode (align_read
+and get_sites) with the traceback strings and per-site scan apollo used
+before (get_site, kept below for comparison).
+
+Simulated reads are assigned to their amplicon first, then only the
+traceback and site extraction are timed, in-process:
+
+    python benchmarks/site_extraction.py -s mus -n 2000
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+
+import parasail
+
+thisdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(thisdir, "..", "apollo", "scripts"))
+import paramether
+import referencefunks
+import simulate_reads
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time CpG site extraction against the old per-site traceback scan')
+    parser.add_argument("-s", "--species", action="store", type=str, dest="species", default="mus")
+    parser.add_argument("-n", "--reads", action="store", type=int, dest="reads", default=2000)
+    parser.add_argument("--repeats", action="store", type=int, dest="repeats", default=3)
+    return parser.parse_args()
+
+def align_read_traceback(query, reference, matrix, gap_open=3, gap_extension=2):
+    # the alignment as apollo took it before, with '|'/'.' traceback strings
+    result_trace = parasail.sw_trace_striped_sat(query, reference, gap_open, gap_extension, matrix)
+    traceback = result_trace.get_traceback('|', '.', ' ')
+    reference_start = result_trace.end_ref - (len(traceback.ref) - traceback.ref.count("-")) + 1
+    return {
+            "reference_start": reference_start,
+            "aln_len": len(traceback.ref),
+            "ref": traceback.ref,
+            "query": traceback.query
+        }
+
+def get_site(cpg_index, stats):
+    # the old extraction, which scans the whole alignment once for every site
+    adjusted_index = cpg_index - stats["reference_start"]
+    current_index = 0
+
+    variant = ""
+    for i in range(int(stats["aln_len"])):
+        if adjusted_index == current_index:
+            variant = stats["query"][i]
+
+        if stats["ref"][i] != '-':
+            current_index +=1
+
+    return variant
+
+def assign_reads(reads, references, matrix):
+    """(read in the forward orientation, gene) of every read that passes the
+    identity threshold, as count_read aligns them."""
+    assigned = []
+    for read in reads:
+        stats = paramether.get_best_reference(read, references, matrix)
+        if stats["identity"] <= 0.75:
+            continue
+        gene, direction = stats["reference"].rsplit("_", 1)
+        if direction == "reverse":
+            read = referencefunks.reverse_complement(read)
+        assigned.append((read, gene))
+    return assigned
+
+def time_per_read(function, reads, repeats):
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(reads) * 1e6
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    references = paramether.load_reference_dict(simulate_reads.get_data_file(args.species, "genes.fasta"))
+    cpg_dict = paramether.load_cpg_dict(simulate_reads.get_data_file(args.species, "cpg_sites.csv"))
+    matrix = paramether.make_nuc_matrix(referencefunks.read_substitution_matrix(os.path.join(simulate_reads.data_dir, "substitution_matrix.txt")))
+    reads = simulate_reads.simulate_reads(simulate_reads.get_data_file(args.species, "genes.fasta"), args.reads)
+    assigned = assign_reads(reads, references, matrix)
+
+    old_alignments = [align_read_traceback(read, references[gene + "_forward"], matrix) for read, gene in assigned]
+    new_alignments = [paramether.align_read(read, gene, references[gene + "_forward"], matrix) for read, gene in assigned]
+
+    def old_sites(alignments=old_alignments):
+        return [[get_site(site[1], alignment) for site in cpg_dict[gene]] for (read, gene), alignment in zip(assigned, alignments)]
+
+    def new_sites(alignments=new_alignments):
+        return [paramether.get_sites(cpg_dict[gene], alignment) for (read, gene), alignment in zip(assigned, alignments)]
+
+    def old_traceback_and_sites():
+        return old_sites([align_read_traceback(read, references[gene + "_forward"], matrix) for read, gene in assigned])
+
+    def new_traceback_and_sites():
+        return new_sites([paramether.align_read(read, gene, references[gene + "_forward"], matrix) for read, gene in assigned])
+
+    rows = [
+        ("site extraction only", old_sites, new_sites),
+        ("traceback + all sites", old_traceback_and_sites, new_traceback_and_sites)
+    ]
+    print(f"{len(assigned)} of {len(reads)} simulated {args.species} reads assigned, us per read (min of {args.repeats} runs)")
+    print(f"  {'':24s} {'get_site':>10s} {'get_sites':>10s}")
+    for name, old_function, new_function in rows:
+        print(f"  {name:24s} {time_per_read(old_function, assigned, args.repeats):10.1f} {time_per_read(new_function, assigned, args.repeats):10.1f}")
+
+    # the kernels can place a gap differently next to a site, so a few calls may differ
+    differences = collections.Counter()
+    for old_calls, new_calls in zip(old_sites(), new_sites()):
+        differences["reads"] += old_calls != new_calls
+        differences["sites"] += sum(old_call != new_call for old_call, new_call in zip(old_calls, new_calls))
+    print(f"Site calls that differ: {differences['sites']} in {differences['reads']} reads")
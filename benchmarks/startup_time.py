@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Check that `apollo -v` starts within a time budget.
+
+Runs `apollo -v` under `python -X importtime`, subtracts the time a bare
+interpreter takes to start, and exits with an error listing the slowest
+imports if what is left is over the budget:
+
+    python benchmarks/startup_time.py --budget 100
+"""
+import argparse
+import shutil
+import subprocess
+import sys
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the startup time of apollo -v against a budget')
+    parser.add_argument("--budget", action="store", type=float, dest="budget", default=100,
+                        help="Milliseconds apollo -v may take on top of starting python. Default: 100")
+    parser.add_argument("--repeats", action="store", type=int, dest="repeats", default=5)
+    parser.add_argument("--top", action="store", type=int, dest="top", default=10,
+                        help="Number of slowest imports to list")
+    return parser.parse_args()
+
+def time_command(command, repeats):
+    # the fastest of several runs is the least disturbed by everything else on the machine
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+def get_import_times(command):
+    """Cumulative milliseconds spent importing each module, from -X importtime."""
+    process = subprocess.run([sys.executable, "-X", "importtime"] + command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True, check=True)
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        import_times[module.strip()] = int(cumulative_us) / 1000
+    return import_times
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # the installed entry point is run by path, so its directory (where the
+    # pipeline scripts are installed) is on sys.path as it is for users
+    apollo = shutil.which("apollo")
+    if not apollo:
+        sys.stderr.write("Error: apollo is not installed on the PATH\n")
+        sys.exit(-1)
+
+    python_ms = time_command(["-c", "pass"], args.repeats)
+    apollo_ms = time_command([apollo, "-v"], args.repeats) - python_ms
+    import_times = get_import_times([apollo, "-v"])
+
+    print(f"apollo -v: {apollo_ms:.0f} ms on top of {python_ms:.0f} ms python startup (budget {args.budget:.0f} ms)")
+    print(f"import apollo.command: {import_times.get('apollo.command', 0):.0f} ms")
+    if apollo_ms > args.budget:
+        print("Slowest imports:")
+        for module in sorted(import_times, key=import_times.get, reverse=True)[:args.top]:
+            print(f"  {import_times[module]:8.1f} ms  {module}")
+        sys.stderr.write(f"Error: apollo -v took {apollo_ms:.0f} ms, over the {args.budget:.0f} ms budget\n")
+        sys.exit(1)
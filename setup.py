@@ -1,7 +1,6 @@
 from setuptools import setup, find_packages
 import glob
 import os
-import pkg_resources
 
 from apollo import __version__, _program
 
@@ -13,16 +12,24 @@ setup(name='apollo',
             "apollo/scripts/custom_logger.py",
             "apollo/scripts/log_handler_handle.py",
             "apollo/scripts/apollofunks.py",
-            "apollo/scripts/count_cpgs.smk"],
+            "apollo/scripts/fastqfunks.py",
+            "apollo/scripts/watchfunks.py",
+            "apollo/scripts/referencefunks.py",
+            "apollo/scripts/clockfunks.py",
+            "apollo/scripts/demuxer.py",
+            "apollo/scripts/count_cpgs.smk",
+            "apollo/scripts/batch.smk"],
       package_data={"apollo":["data/*",
                   "data/phalacrocorax/*",
                   "data/mus/*",
                   "data/desmodus/*",
                   "data/apodemus/*"]},
+      python_requires=">=3.9",
       install_requires=[
             "biopython>=1.70",
             "numpy>=1.13.3",
-            "parasail"
+            "parasail",
+            "pyyaml"
         ],
       description='Predicted Epigenetic Age Clock',
       url='github.com/cov-lineages/apollo',